@@ -1,13 +1,18 @@
-import struct, sys, os, getopt
+import struct, sys, os, getopt, math
+from array import array
 
 def wordsToBytes(words):
-    v = []
-    for word in words: v.extend([(word >> 8) & 0xFF, word & 0xFF])
-    return bytes(v)
+    if type(words) is not array or words.typecode != "H": words = array("H", [word & 0xFFFF for word in words])
+    elif sys.byteorder == "little": words = array("H", words)
+    if sys.byteorder == "little": words.byteswap() # Words are stored big-endian
+    return words.tobytes()
 
 def bytesToWords(bytes):
     if len(bytes) % 2 != 0: raise Exception("Cannot convert an odd about of bytes to words.")
-    return [(bytes[i] << 8) | bytes[i+1] for i in range(0, len(bytes), 2)]
+    words = array("H")
+    words.frombytes(bytes)
+    if sys.byteorder == "little": words.byteswap()
+    return words.tolist()
 
 def packedWordStrToStr(words):
     str = ""
@@ -31,8 +36,7 @@ def strToPackedWordStr(str):
 class GeneralSection:
     def __init__(self, words=None):
         if not words: words = []
-        self.words = []
-        self.words.extend(words)
+        self.words = array("H", words)
     
     def getSize(self):
         return len(self.words)
@@ -53,6 +57,30 @@ class GeneralSection:
     def deserializeWords(cls, words):
         return GeneralSection(words)        
 
+# NOBITS sections have no data in the file, so only their size is kept
+class NobitsSection:
+    def __init__(self, size=0):
+        self.size = size
+    
+    def getSize(self):
+        return self.size
+    
+    @classmethod
+    def serializeBytes(cls, section):
+        return b""
+    
+    @classmethod
+    def serializeWords(cls, section):
+        return array("H")
+    
+    @classmethod
+    def deserializeBytes(cls, bytes):
+        return NobitsSection(len(bytes)//2)
+    
+    @classmethod
+    def deserializeWords(cls, words):
+        return NobitsSection(len(words))
+
 class Relocation:
     ENTRYSIZE = 4
     
@@ -132,52 +160,90 @@ class RelocTable:
         return cls.deserializeBytes(wordsToBytes(words))
 
 class StringTable:
+    # Besides the packed strings, the table keeps the offset of the first copy of each string
+    # (ids) and the strings already read by offset (strings), so that neither interning nor
+    # lookups scan pStrings. Strings are only ever appended, so both stay valid.
     def __init__(self, pStrings=None):
         if not pStrings: pStrings = []
         self.pStrings = []
         if len(pStrings) == 0 or pStrings[0] != 0: self.pStrings = [0]
         self.pStrings.extend(pStrings)
         if self.pStrings[-1] != 0: self.pStrings.append(0)
+        self.__index()
+
+    def __index(self):
+        self.ids = {}
+        self.strings = {}
+        start = 0
+        while start < len(self.pStrings):
+            end = self.pStrings.index(0, start)
+            pString = self.pStrings[start:end]
+            try:
+                string = packedWordStrToStr(pString)
+            except Exception:
+                string = None
+            # Only strings packed back to the same words, as getIDByString compares words
+            if string is not None and string not in self.ids and strToPackedWordStr(string) == pString:
+                self.ids[string] = start
+            start = end + 1
     
     def getSize(self):
         return len(self.pStrings)
     
     def getStringByID(self, id):
-        pString = []
-        i = id
-        while self.pStrings[i] != 0:
-            pString.append(self.pStrings[i])
-            i += 1
-        return packedWordStrToStr(pString)
+        string = self.strings.get(id)
+        if string is None:
+            pString = []
+            i = id
+            while self.pStrings[i] != 0:
+                pString.append(self.pStrings[i])
+                i += 1
+            string = self.strings[id] = packedWordStrToStr(pString)
+        return string
 
     def getIDByString(self, string):
+        id = self.ids.get(string)
+        if id is not None: return id
         pMatch = strToPackedWordStr(string)
-        pString = []
-        id = i = 0
-        while i < len(self.pStrings):
-            if self.pStrings[i] == 0:
-                if pString == pMatch: return id
-                pString = []
-                id = i + 1
-            else:
-                pString.append(self.pStrings[i])
-            i += 1
+        id = len(self.pStrings)
         self.pStrings.extend(pMatch)
         self.pStrings.append(0)
+        self.ids[string] = id
         return id
     
     def containsString(self, string):
-        pMatch = strToPackedWordStr(string)
-        pString = []
-        i = 0
-        while i < len(self.pStrings):
-            if self.pStrings[i] == 0:
-                if pString == pMatch: return True
-                pString = []
+        return string in self.ids
+
+    # Rewrites the table to hold only the strings at the given offsets, each stored once,
+    # with every string that ends another one stored as the tail of that one. Returns the
+    # new offset of each of the given offsets. Strings are packed 2 characters per word, so
+    # only tails starting on a word boundary of the longer string can be shared.
+    def compact(self, ids):
+        pStrings = {}
+        for id in sorted(ids):
+            pStrings.setdefault(id, tuple(self.pStrings[id:self.pStrings.index(0, id)]))
+        unique = list(dict.fromkeys(pStrings.values()))
+        # Sorted by reversed words, each string directly follows the strings it is a tail of
+        host, previous = {(): ()}, None
+        for pString in sorted(unique, key=lambda p: p[::-1], reverse=True):
+            if not pString: continue
+            if previous is not None and previous[len(previous)-len(pString):] == pString:
+                host[pString] = host[previous]
             else:
-                pString.append(self.pStrings[i])
-            i += 1
-        return False
+                host[pString] = pString
+            previous = pString
+        words, offsets = [0], {(): 0}
+        for pString in unique:
+            if pString and host[pString] == pString:
+                offsets[pString] = len(words)
+                words.extend(pString)
+                words.append(0)
+        for pString in unique:
+            hostString = host[pString]
+            offsets[pString] = offsets[hostString] + len(hostString) - len(pString)
+        self.pStrings = words
+        self.__index()
+        return {id: offsets[pString] for id, pString in pStrings.items()}
 
     @classmethod
     def serializeBytes(cls, strtab):
@@ -255,15 +321,23 @@ class SymbolTable:
         return self.symbols[id]
     
     def addSymbol(self, file, symbol, addWithName=True):
-        id = len(self.symbols)
-        self.symbols.append(symbol)
+        return self.addSymbols(file, [symbol], addWithName).start
+
+    # Adds the symbols in order, the same as addSymbol would one at a time, but fetches the
+    # tables once. Returns the range of their ids.
+    def addSymbols(self, file, symbols, addWithName=True):
+        ids = range(len(self.symbols), len(self.symbols) + len(symbols))
+        self.symbols.extend(symbols)
         if addWithName:
             symtab_header, _ = file.getSection(file.header.h_symtabndx)
             _, hashtab = file.getSection(file.header.h_hashtabndx)
             _, symstrtab = file.getSection(symtab_header.sh_link)
-            hashtab.addSymbolIDByName(symstrtab.getStringByID(symbol.s_name), id)
-            file.rehash()
-        return id
+            hashtab.index(file)
+            for id in ids:
+                hashtab.addSymbolIDByName(symstrtab.getStringByID(self.symbols[id].s_name), id)
+                if not file.deferred: file.rehash(id + 1)
+            if file.deferred: file.rehash()
+        return ids
     
     def getIDBySymbol(self, symbol):
         if not symbol in self.symbols: return 0
@@ -290,6 +364,8 @@ class SymbolTable:
         return cls.deserializeBytes(wordsToBytes(words))
 
 class HashTable:
+    MAXLOAD = 0.75
+
     @classmethod
     def _hashSymbol(cls, str):
         if not str.isascii(): raise Exception("Non-ASCII strings are not supported in HashTable.")
@@ -303,6 +379,10 @@ class HashTable:
         _, symstrtab = file.getSection(symtab_header.sh_link)
         return symstrtab.getStringByID(symtab.getSymbolByID(symid).s_name)
     
+    # Lookups go through a dict of the names in the table (names), and the hash of the name of
+    # every symbol in the table is kept by id (hashes), in the order they were added. Only the
+    # bucket heads are kept up to date, for the load factor. The chains are built when the table
+    # is serialized. A table read from a file is indexed the first time it is used with its file.
     def __init__(self, nbucket, nchain):
         if nbucket == 0: raise Exception("nbucket of Hash Table cannot be 0.")
         if nchain == 0: raise Exception("nchain of Hash Table cannot be 0.")
@@ -311,54 +391,90 @@ class HashTable:
         self.bucket = [0]*nbucket
         self.chain = [0]*nchain
         self._occupied = 0
+        self.names = {}
+        self.hashes = {}
     
     def getLoadFactor(self):
         return self._occupied / self.nbucket
      
     def getSize(self):
-        return 4 + 2*len(self.bucket) + 2*len(self.chain)
+        return 4 + 2*self.nbucket + 2*self.nchain
+
+    def index(self, file):
+        if self.names is not None: return
+        self.names = {}
+        symids = []
+        for symid in self.bucket:
+            i = 0
+            while symid != 0 and i <= self.nchain:
+                symids.append(symid)
+                self.names.setdefault(HashTable._getSymbolNameByID(file, symid), symid)
+                symid = self.chain[symid]
+                i += 1
+        self.hashes = {symid: HashTable._hashSymbol(HashTable._getSymbolNameByID(file, symid)) for symid in sorted(symids)}
 
     def containsName(self, file, name):
-        try:
-            self.getSymbolIDByName(file, name)
-            return True
-        except Exception:
-            return False
+        self.index(file)
+        return name in self.names
    
     def getSymbolIDByName(self, file, name):
-        hash = HashTable._hashSymbol(name) % self.nbucket
-        symid = self.bucket[hash]
-        if symid == 0: raise Exception("No such symbol.")
-        if HashTable._getSymbolNameByID(file, symid) == name: return symid
-        i = 0
-        while i < self.nchain:
-            symid = self.chain[symid]
-            if symid == 0: raise Exception("No such symbol.")
-            if HashTable._getSymbolNameByID(file, symid) == name: return symid
-            i += 1
-        raise Exception("No such symbol.")
+        self.index(file)
+        symid = self.names.get(name)
+        if symid is None: raise Exception("No such symbol.")
+        return symid
 
     def addSymbolIDByName(self, name, id):
-        hash = HashTable._hashSymbol(name) % self.nbucket
-        symid = self.bucket[hash]
-        if symid == id: return
-        if symid == 0:
-            self.bucket[hash] = id
+        hash = HashTable._hashSymbol(name)
+        if id == 0 or id in self.hashes: return
+        self.hashes[id] = hash
+        self.names.setdefault(name, id)
+        if self.bucket[hash % self.nbucket] == 0:
+            self.bucket[hash % self.nbucket] = id
             self._occupied += 1
-            return
-        i = 0
-        while i < self.nchain:
-            o_symid = symid
-            symid = self.chain[o_symid]
-            if symid == id: return
-            if symid == 0:
-                self.chain[o_symid] = id
-                return
-            i += 1
-        raise Exception("No space left in hash table.")
+
+    # Gives the table nbucket buckets, keeping the symbols in it
+    def resize(self, nbucket):
+        self.nbucket = nbucket
+        self.bucket = [0]*nbucket
+        for symid, hash in self.hashes.items():
+            if self.bucket[hash % nbucket] == 0:
+                self.bucket[hash % nbucket] = symid
+                self._occupied += 1
+
+    # Gives the table nbucket buckets and puts every symbol below count in it. Only the names
+    # of the symbols that were not in it yet are read and hashed.
+    def rebuild(self, file, nbucket, count):
+        hashes = {}
+        for symid in range(1, count):
+            hash = self.hashes.get(symid)
+            if hash is None:
+                name = HashTable._getSymbolNameByID(file, symid)
+                hash = HashTable._hashSymbol(name)
+                if self.names.get(name, count) > symid: self.names[name] = symid
+            hashes[symid] = hash
+        self.hashes = hashes
+        self.resize(nbucket)
+
+    # Makes room for count symbols without going over MAXLOAD
+    def reserve(self, count):
+        nbucket = math.ceil(count / HashTable.MAXLOAD)
+        if nbucket > self.nbucket:
+            self._occupied = 0
+            self.resize(nbucket)
+
+    # Builds the chains, each in the order its symbols were added
+    def buildChains(self):
+        if self.names is None: return
+        self.chain = [0]*self.nchain
+        last = {}
+        for symid, hash in self.hashes.items():
+            b = hash % self.nbucket
+            if b in last: self.chain[last[b]] = symid
+            last[b] = symid
     
     @classmethod
     def serializeBytes(cls, hashtab):
+        hashtab.buildChains()
         s = bytearray(struct.pack(">4H",
                                   hashtab.nbucket & 0xFFFF, (hashtab.nbucket >> 16) & 0xFFFF,
                                   hashtab.nchain & 0xFFFF, (hashtab.nchain >> 16) & 0xFFFF
@@ -384,8 +500,9 @@ class HashTable:
             bucketlo, buckethi = struct.unpack(">2H", bytes[8+4*i:12+4*i])
             hashtab.bucket[i] = (buckethi << 16) | bucketlo
         for i in range(nchain):
-            chainlo, chainhi = struct.unpack(">2H", bytes[8+2*(nbucket+2*i):12+2*(nbucket+2*i)])
+            chainlo, chainhi = struct.unpack(">2H", bytes[8+4*(nbucket+i):12+4*(nbucket+i)])
             hashtab.chain[i] = (chainhi << 16) | chainlo
+        hashtab.names = None
         return hashtab
     
     @classmethod
@@ -527,6 +644,7 @@ class SLBFManager:
         self.header = SLBFHeader(h_type, 0, 0, 1, 0, 0, 0)
         self.sht = []
         self.sections = []
+        self.deferred = False
     
     @classmethod
     def newFile(cls, h_type):
@@ -553,22 +671,26 @@ class SLBFManager:
         
         return file
     
-    def rehash(self):
+    # Grows the hash table for the first count symbols (Default all of them) if it is too full.
+    # Growing puts every one of these symbols in the table, named or not.
+    def rehash(self, count=None):
         _, hashtab = self.getSection(self.header.h_hashtabndx)
-        symtab_header, symtab = self.getSection(self.header.h_symtabndx)
-        _, symstrtab = self.getSection(symtab_header.sh_link)
-                
-        if hashtab.nchain < len(symtab.symbols):
-            hashtab.chain.extend([0]*(len(symtab.symbols)-hashtab.nchain))
-            hashtab.nchain = len(hashtab.chain)
-        if hashtab.getLoadFactor() > 0.75:
-            hashtab.bucket = [0]*int(hashtab.nbucket * 1.5)
-            hashtab.nbucket = len(hashtab.bucket)
-            hashtab.chain = [0]*hashtab.nchain
-            for i in range(len(symtab.symbols)):
-                symbol = symtab.symbols[i]
-                symname = symstrtab.getStringByID(symbol.s_name)
-                hashtab.addSymbolIDByName(symname, i)
+        _, symtab = self.getSection(self.header.h_symtabndx)
+        if count is None: count = len(symtab.symbols)
+        
+        hashtab.index(self)
+        hashtab.nchain = max(hashtab.nchain, count)
+        if not self.deferred and hashtab.getLoadFactor() > HashTable.MAXLOAD:
+            hashtab.rebuild(self, int(hashtab.nbucket * 1.5), count)
+
+    # Stops growing the hash table as symbols are added, sizing it for nsymbols names now and
+    # for the names it holds when the file is serialized. Symbols added without their name are
+    # then never put in the table.
+    def deferRehash(self, nsymbols=0):
+        _, hashtab = self.getSection(self.header.h_hashtabndx)
+        hashtab.index(self)
+        hashtab.reserve(nsymbols)
+        self.deferred = True
     
     def getSection(self, id):
         return self.sht[id], self.sections[id]
@@ -588,9 +710,26 @@ class SLBFManager:
         self.header.h_shnum = len(self.sht)
         return len(self.sht)-1
     
+    # Compacts every string table that section or symbol names point into, see
+    # StringTable.compact, and points the names at their new offsets
+    def compactStrings(self):
+        names = {}
+        names[self.header.h_shstrndx] = [(hdr, "sh_name") for hdr in self.sht]
+        for hdr, section in zip(self.sht, self.sections):
+            if hdr.sh_type == SectionHeader.SHTYPE_SYMTAB:
+                names.setdefault(hdr.sh_link, []).extend((symbol, "s_name") for symbol in section.symbols)
+        for strndx, refs in names.items():
+            offsets = self.sections[strndx].compact([getattr(obj, attr) for obj, attr in refs])
+            for obj, attr in refs:
+                setattr(obj, attr, offsets[getattr(obj, attr)])
+
     @classmethod
-    def serializeBytes(cls, file):
+    def serializeBytes(cls, file, compact=False):
         SLBFHeader.serializeBytes(file.header)
+        if compact: file.compactStrings()
+        if file.deferred:
+            _, hashtab = file.getSection(file.header.h_hashtabndx)
+            hashtab.reserve(len(hashtab.hashes))
         s = bytearray()
         for i in range(file.header.h_shnum):
             s_header, section = file.getSection(i)
@@ -618,7 +757,7 @@ class SLBFManager:
             addr = file.header.h_shoff + i * file.header.h_shentsize
             s_header = SectionHeader.deserializeBytes(bytes[2*addr:2*(addr+file.header.h_shentsize)])
             if s_header.sh_type == SectionHeader.SHTYPE_NOBITS:
-                file.addSection(s_header, GeneralSection())
+                file.addSection(s_header, NobitsSection(s_header.sh_size))
                 continue
             data = bytes[2*s_header.sh_offset:2*(s_header.sh_offset+s_header.sh_size)]
             if s_header.sh_type == SectionHeader.SHTYPE_INV: sh_type = GeneralSection
@@ -635,7 +774,7 @@ class SLBFManager:
     def deserializeWords(cls, words):
         return cls.deserializeBytes(wordsToBytes(words))
 
-def decode(in_filepath):
+def decode(in_filepath, disassemble=False):
     print("[FILE] "+in_filepath)
     with open(in_filepath, "rb") as f:
         file = SLBFManager.deserializeBytes(f.read())
@@ -698,9 +837,34 @@ def decode(in_filepath):
                 print("\t\tVADDR:\t{} +0x{:X} (0x{:08X})".format(SHSTRTAB.getStringByID(linksect_hdr.sh_name), reloc.r_offset, linksect_hdr.sh_addr+reloc.r_offset))
                 print("\t\tSYMBOL:\t{:<5} - {}".format(reloc.r_symndx, repr(SYMSTRTAB.getStringByID(SYMTAB.symbols[reloc.r_symndx].s_name))))
     
+    if disassemble:
+        import disasm
+        print("\n[DISASSEMBLY]")
+        for i in range(file.header.h_shnum):
+            hdr, section = file.getSection(i)
+            if hdr.sh_type == SectionHeader.SHTYPE_PROGDAT:
+                print("{} - {}:".format(i, SHSTRTAB.getStringByID(hdr.sh_name)))
+                for line in disasm.disassemble(file, i): print(line)
+                print()
+    
 def main(argv):
+    opts, args = getopt.getopt(argv, "dh", ["help", "disassemble"])
+    disassemble = False
+    
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Displays the contents of SLBF files.")
+            print("Usage: py SLBFManager.py [options] files...")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-d | --disassemble: Also disassemble the contents of PROGDAT sections.\n")
+            print("\tfile... is a list of SLBF files to read.\n")
+            exit(0)
+        if o in ["-d", "--disassemble"]:
+            disassemble = True
+    
     files = []
-    for arg in argv:
+    for arg in args:
         print("$ - Finding \""+arg+"\".")
         if not os.path.isfile(arg):
             print("[WARNING] \""+arg+"\" is not a file or does not exist.")
@@ -712,7 +876,7 @@ def main(argv):
     
     for in_filepath in files:
         try:
-            decode(in_filepath)
+            decode(in_filepath, disassemble)
         except Exception as e:
             print("[FATAL] Couldn't decode \""+in_filepath+"\" due to the following exception:")
             print(e)
@@ -1,27 +1,29 @@
-import os, sys, getopt, math
+import os, re, sys, io, mmap, getopt, math, hashlib, operator, contextlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
-from lexer import Lexer
-from opdb import matchInst
+from lexer import Lexer, LexError, Operand, mathop
+from opdb import findInst, encodeMany, shortforms, fitsOffset16
 from SLBFManager import *
+from objcache import ObjectCache
+from preprocessor import Preprocessor, PreprocessError, HeaderCache
 
 verbose = False
 outext = ".o"
 outdir = ""
+lexengine = "fast"
+jobs = 1
+cache = None # ObjectCache for unchanged files, if enabled
+includedirs = []
+defines = {}
+headers = HeaderCache() # Precompiled headers, kept for every file assembled by this process
+INST_BATCH = 1024 # Most instructions queued before they are encoded
+U32 = "I" if array("I").itemsize == 4 else "L"
+RELATIONAL = {"==": operator.eq, "~=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
 
-def wrap32bits(num):
-    num %= 0xFFFFFFFF
-    if num >= 0x80000000: return 0x100000000 - num
-    else: return num
-
-def reprMath(mop):
-    if mop["type"] == "op":
-        mop_str = ""
-        for node in mop["nodes"]:
-            mop_str += mop["op"] + reprMath(node)
-        return mop_str[len(mop["op"]):]
-    elif mop["type"] == "mexpr":
-        return "{" + reprMath(mop["val"]) + "}"
-    return str(mop["val"])
+def reprMath(mexpr):
+    return mexpr.text
 
 def reprOps(ops):
     if len(ops) == 0: return ""
@@ -29,38 +31,83 @@ def reprOps(ops):
         op_str = ""
         reg = ""
         imm = ""
-        if op["rtype"] == "r16": reg = "%"+"ABCDEGMLXYSPUVFZ"[op["rval"]]
-        elif op["rtype"] == "r32": reg = "%"+"ABCDEGMLXYSPUVFZ"[op["rval"]^0b0001]+"ABCDEGMLXYSPUVFZ"[op["rval"]]
-        if op["itype"] == "abs": imm = str(op["ival"])
-        elif op["itype"] == "lbl": imm = op["ival"]
-        elif op["itype"] == "mexpr": imm = "{"+reprMath(op["ival"])+"}"
+        if op.rtype == Operand.RTYPE_R16: reg = "%"+"ABCDEGMLXYSPUVFZ"[op.rval]
+        elif op.rtype == Operand.RTYPE_R32: reg = "%"+"ABCDEGMLXYSPUVFZ"[op.rval^0b0001]+"ABCDEGMLXYSPUVFZ"[op.rval]
+        if op.itype == Operand.ITYPE_ABS: imm = str(op.ival)
+        elif op.itype == Operand.ITYPE_LBL: imm = op.ival
+        elif op.itype == Operand.ITYPE_MEXPR: imm = "{"+reprMath(op.ival)+"}"
+        elif op.itype == Operand.ITYPE_STR: imm = "\""+op.ival+"\""
+        elif op.itype == Operand.ITYPE_DATA: imm = ", ".join(map(str, op.ival))
         if reg:
-            if op["rtype"] == "r16" and (not imm or op["rval"] != 15): op_str = reg
-            elif op["rtype"] == "r32": op_str = reg
+            if op.rtype == Operand.RTYPE_R16 and (not imm or op.rval != 15): op_str = reg
+            elif op.rtype == Operand.RTYPE_R32: op_str = reg
             if imm: reg += "+"
         if imm: op_str += imm
-        if op["ismem"]: op_str = "$("+op_str+")"
+        if op.ismem: op_str = "$("+op_str+")"
         return op_str
     out_str = ""
     for op in ops:
         out_str += reprOp(op) + ", "
     return out_str[:-2]
 
-def assemble(in_filepath, out_dirpath):
-    if verbose:
-        print("[FILE] "+in_filepath)
-        print("$ - Begin Lexer")
-    lines = Lexer.lexfile(in_filepath)
-    if verbose:
-        for line in lines:
-            line_str = str(line["ln"])+":\t"
-            if line["label"]: line_str += line["label"]+": "
-            if line["cmd"]:
-                line_str += "\t" + line["cmd"]
-                if line["ops"]: line_str += "\t" + reprOps(line["ops"])
-            print(line_str)
-        print("$ - End Lexer\n")
-        print("$ - Begin Translation")
+# Where a preprocessed line comes from: its line number, or the file and line of an included line
+def reprLn(ln):
+    return ":".join(str(part) for part in ln) if isinstance(ln, tuple) else str(ln)
+
+def reprLine(line):
+    line_str = reprLn(line.ln)+":\t"
+    if line.label: line_str += line.label+": "
+    if line.cmd:
+        line_str += "\t" + line.cmd
+        if line.ops: line_str += "\t" + reprOps(line.ops)
+    return line_str
+
+_INCBIN = re.compile(r"""^(?:[a-z_.@][\w.@]*:)?\s+\.incbin\s+("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')""", re.ASCII | re.IGNORECASE | re.MULTILINE)
+
+# Binary files are searched like #include files: in the directory of the source, then in -I
+def findBinary(path, directory):
+    for base in [directory] + includedirs:
+        candidate = os.path.join(base, path)
+        if os.path.isfile(candidate): return candidate
+    raise Exception("Couldn't find binary file \""+path+"\".")
+
+# Returns length bytes of a file from offset (Default: up to its end) as big-endian words.
+# The file is mapped rather than read, and an odd last byte is padded with 0.
+def readBinary(path, offset=0, length=None):
+    words = array("H")
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if length is None else offset + length
+        if offset > size: raise Exception("Offset "+str(offset)+" is past the end of \""+path+"\" ("+str(size)+" bytes).")
+        if end > size: raise Exception("Bytes "+str(offset)+" to "+str(end)+" are past the end of \""+path+"\" ("+str(size)+" bytes).")
+        if end == offset: return words
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            with memoryview(data) as view:
+                words.frombytes(view[offset:end - (end - offset) % 2])
+                if sys.byteorder == "little": words.byteswap()
+                if (end - offset) % 2: words.append(view[end-1] << 8)
+    return words
+
+class AssemblyError(Exception):
+    def __init__(self, message, ln=None, filename=None):
+        super().__init__(message)
+        if isinstance(ln, tuple): filename, ln = ln # A line from an included file
+        self.message = message
+        self.ln = ln
+        self.filename = filename
+    
+    def __str__(self):
+        where = ":".join(str(part) for part in [self.filename, self.ln] if part is not None)
+        return (where + ": " if where else "") + self.message
+
+# Translates lexed lines into an object. lex(condition) returns the lexed lines, with
+# conditional blocks tested by condition, and .incbin files are searched from directory.
+# Shrinkable offsets (address or memory offsets given by .set symbols or math expressions of them)
+# are numbered in order, and all but the ones in widen are encoded with a 16-bit immediate.
+# Returns the object (None if a shrunk offset does not fit) and whether each shrinkable
+# offset fits in 16 bits. The words of .incbin files are kept in binaries if it is given.
+def translate(lex, widen, directory, binaries=None):
+    if verbose: print("$ - Begin Translation")
     file = SLBFManager.newFile(SLBFHeader.HTYPE_OBJ)
     
     SHSTRTAB_HDR, SHSTRTAB = file.getSection(file.header.h_shstrndx)
@@ -74,12 +121,18 @@ def assemble(in_filepath, out_dirpath):
     SYMTAB.addSymbol(file, _sp)
     
     MEXPR_RELOCS = []
+    SHRINKABLE = []
+    UNDEFINED = {} # Non-extern undefined symbol IDs -> (section, relocation) pairs to patch once defined
+    VALUES = {} # Defined symbol names -> values
+    SETS = {} # .set symbols whose value needs symbols defined later -> (expression, line)
+    CONSTANTS = set() # Names of the symbols defined by .set
     CUR_SECTION_HDR, CUR_SECTION = None, None
     REL_SECTION_HDR, REL_SECTION = None, None
     
     def defSym(symname, value, section=None):
         if not section: section = file.getIDBySection(CUR_SECTION)
         if not section: raise Exception("Section must be defined when defining a symbol.")
+        if symname in SETS: raise Exception("Cannot redefine symbol \""+symname+"\".")
         if HASHTAB.containsName(file, symname):
             symid = HASHTAB.getSymbolIDByName(file, symname)
             symbol = SYMTAB.getSymbolByID(symid)
@@ -87,18 +140,13 @@ def assemble(in_filepath, out_dirpath):
             if symbol.s_info == Symbol.SINFO_EXTERN: raise Exception("Cannot define external symbol \""+symname+"\"in the same file.")
             symbol.s_value = value
             symbol.s_shndx = section
-            for i in range(file.header.h_shnum):
-                header, rtab = file.getSection(i)
-                if header.sh_type == SectionHeader.SHTYPE_RELTAB:
-                    shdr, section = file.getSection(header.sh_link)
-                    for reloc in rtab.relocs:
-                        if reloc.r_symndx != symid: continue
-                        section.words[reloc.r_offset] = (symbol.s_value) & 0xFFFF
-                        section.words[reloc.r_offset+1] = ((symbol.s_value) >> 16) & 0xFFFF
-                        
+            for target, reloc in UNDEFINED.pop(symid):
+                target.words[reloc.r_offset] = (symbol.s_value) & 0xFFFF
+                target.words[reloc.r_offset+1] = ((symbol.s_value) >> 16) & 0xFFFF
         else:
             symbol = Symbol(SYMSTRTAB.getIDByString(symname), value, Symbol.SINFO_LOCAL, section)
             SYMTAB.addSymbol(file, symbol)
+        VALUES[symname] = value
         return symbol
     
     def defRel(symname, offset):
@@ -114,142 +162,241 @@ def assemble(in_filepath, out_dirpath):
             symid = HASHTAB.getSymbolIDByName(file, symname)
         else:
             symid = SYMTAB.addSymbol(file, Symbol(SYMSTRTAB.getIDByString(symname), 0, Symbol.SINFO_LOCAL, Symbol.SDEF_UNDEF))
+            UNDEFINED[symid] = []
         reloc = Relocation(offset, symid)
         REL_SECTION.relocs.append(reloc)
+        if symid in UNDEFINED: UNDEFINED[symid].append((CUR_SECTION, reloc))
         return reloc
 
+    # Instructions are queued until a label or directive needs @ip, then encoded in bulk.
+    INSTS, INST_LINES = [], []
+    def encodeInsts():
+        words = CUR_SECTION.words
+        base = len(words)
+        delta = _ip.s_value - _sp.s_value - base # Relocation offsets are taken relative to @sp
+        offsets, indices, opNs = encodeMany(INSTS, words)
+        for offset, i, opN in zip(offsets, indices, opNs):
+            op = INSTS[i][1][opN]
+            if op.itype == Operand.ITYPE_MEXPR:
+                MEXPR_RELOCS.append({"offset": offset + delta,
+                                     "line": INST_LINES[i],
+                                     "shndx": file.getIDBySection(CUR_SECTION),
+                                     "mexpr": op.ival})
+            elif op.itype == Operand.ITYPE_LBL:
+                relobj = defRel(op.ival, offset + delta)
+                symbol = SYMTAB.getSymbolByID(relobj.r_symndx)
+                words[offset] = symbol.s_value & 0xFFFF
+                words[offset+1] = (symbol.s_value >> 16) & 0xFFFF
+        _ip.s_value += len(words) - base
+        INSTS.clear()
+        INST_LINES.clear()
+
+    # Consecutive constant operands of data directives are lexed into a single list of
+    # values, which is range checked and appended at once
+    def appendWords(values, cmd):
+        if min(values) < -0x8000 or max(values) >= 0x8000: raise Exception(cmd+" arguments must be 16-bit.")
+        CUR_SECTION.words.frombytes(array("h", values).tobytes())
+        _sp.s_value = CUR_SECTION.getSize()
+        _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
+    
+    def appendAddresses(values):
+        if min(values) < 0 or max(values) > 0xFFFFFFFF: values = [value & 0xFFFFFFFF for value in values]
+        words = array("H")
+        words.frombytes(array(U32, values).tobytes())
+        if sys.byteorder == "big": words[0::2], words[1::2] = words[1::2], words[0::2] # Low word first
+        CUR_SECTION.words.extend(words)
+        _sp.s_value = CUR_SECTION.getSize()
+        _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
+
+    def resolve(symname):
+        if symname == "@ip": return _ip.s_value
+        if symname == "@sp": return _sp.s_value
+        return VALUES.get(symname)
+
+    # Labels can be moved by the linker and @ip and @sp change, only .set symbols have a final value
+    def isConstant(symname):
+        return symname in CONSTANTS
+    
+    # Only offsets whose value is final when assembling can be shrunk
+    def isShrinkable(op):
+        if op.itype == Operand.ITYPE_LBL: return isConstant(op.ival)
+        if op.itype == Operand.ITYPE_MEXPR: return all(isConstant(item) for item in op.ival.code if type(item) is str)
+        return False
+
     def evalimm(ival):
         if isinstance(ival, int): return {"type": "abs", "val": ival}
         if isinstance(ival, str):
-            if HASHTAB.containsName(file, ival):
-                symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByName(file, ival))
-                if symbol.s_shndx != Symbol.SDEF_UNDEF:
-                    return {"type": "abs", "val": symbol.s_value}
+            val = resolve(ival)
+            if val is not None: return {"type": "abs", "val": val}
             return {"type": "lbl", "val": ival}
-        if ival["type"] in ["abs", "lbl", "mexpr"]: return evalimm(ival["val"])
-        if ival["type"] == "op":
-            op = ival["op"]
-            nodes = []
-            isimm = True
-            for node in ival["nodes"]:
-                enode = evalimm(node)
-                if enode["type"] != "abs": isimm = False
-                nodes.append(enode)
-            if not isimm: return {"type": "op", "op": op, "nodes": nodes}
-            if op in "~":
-                if len(nodes) != 1: raise Exception("Operator "+op+" expected 1 argument, got "+str(len(nodes)))
-                op1 = nodes[0]["val"]
-                if op == "~": val = -op1-1
-                return {"type": "abs", "val": wrap32bits(val)}
-            elif op in "+-*/%&|^<>":
-                if len(nodes) != 2: raise Exception("Operator "+op+" expected 2 arguments, got "+str(len(nodes)))
-                op1, op2 = nodes[0]["val"], nodes[1]["val"]
-                if op == "+": val = op1 + op2
-                elif op == "-": val = op1 - op2
-                elif op == "*": val = op1 * op2
-                elif op == "/": val = op1 // op2
-                elif op == "%": val = op1 % op2
-                elif op == "&": val = op1 & op2
-                elif op == "|": val = op1 | op2
-                elif op == "^": val = op1 ^ op2
-                elif op == "<": val = 0xFFFFFFFF if wrap32bits(op1) < wrap32bits(op2) else 0
-                elif op == ">": val = 0xFFFFFFFF if wrap32bits(op1) > wrap32bits(op2) else 0
-                return {"type": "abs", "val": wrap32bits(val)}
-            elif op in ["<<", ">>", "==", "~=", "<=", ">="]:
-                if len(nodes) != 2: raise Exception("Operator "+op+" expected 2 arguments, got "+str(len(nodes)))
-                op1, op2 = nodes[0]["val"], nodes[1]["val"]
-                if op == "<<": val = op1 << op2
-                elif op == ">>": val = op1 >> op2
-                elif op == "==": val = 0xFFFFFFFF if wrap32bits(op1) == wrap32bits(op2) else 0
-                elif op == "~=": val = 0xFFFFFFFF if wrap32bits(op1) != wrap32bits(op2) else 0
-                elif op == "<=": val = 0xFFFFFFFF if wrap32bits(op1) <= wrap32bits(op2) else 0
-                elif op == ">=": val = 0xFFFFFFFF if wrap32bits(op1) >= wrap32bits(op2) else 0
-                return {"type": "abs", "val": wrap32bits(val)}
+        val = ival.bind(resolve)
+        if isinstance(val, int): return {"type": "abs", "val": val}
+        if val.getSymbol(): return {"type": "lbl", "val": val.getSymbol()}
+        return {"type": "op", "val": val}
+    
+    # Expressions left for the end of the translation only depend on the final symbol
+    # values, so equal ones (like the copies made by .pada) are evaluated once
+    MEMO = {}
+    def evaldeferred(ival):
+        key = ival if isinstance(ival, str) else tuple(ival.code)
+        if key not in MEMO: MEMO[key] = evalimm(ival)
+        return MEMO[key]
+    
+    def dependencies(symname):
+        ival = SETS[symname][0]
+        return [item for item in ([ival] if isinstance(ival, str) else ival.code) if type(item) is str and item in SETS]
+    
+    # Defines the deferred .set symbols, each after the ones its value depends on
+    def defineSets():
+        state = {} # 1 while the symbol's dependencies are being defined, 2 once it is defined
+        for root in list(SETS):
+            if root in state: continue
+            state[root] = 1
+            stack = [(root, iter(dependencies(root)))]
+            while stack:
+                symname, deps = stack[-1]
+                for dep in deps:
+                    if state.get(dep) == 1:
+                        cycle = [name for name, _ in stack]
+                        cycle = cycle[cycle.index(dep):] + [dep]
+                        raise AssemblyError("Circular .set definition: "+" -> ".join(name+" (line "+reprLn(SETS[name][1])+")" for name in cycle)+".", SETS[dep][1])
+                    if dep not in state:
+                        state[dep] = 1
+                        stack.append((dep, iter(dependencies(dep))))
+                        break
+                else:
+                    stack.pop()
+                    state[symname] = 2
+                    ival, ln = SETS.pop(symname)
+                    value = evaldeferred(ival)
+                    if value["type"] != "abs": raise AssemblyError(".set 2nd argument must be immediate or mexpr with all labels defined.", ln)
+                    try:
+                        defSym(symname, value["val"], Symbol.SDEF_ABS)
+                        CONSTANTS.add(symname)
+                    except Exception as e:
+                        raise AssemblyError(str(e), ln) from e
+    
+    # Tests the condition of a conditional directive against the .set symbols defined so far.
+    # Relational operators give 1 or 0 here, and constants are not folded by the lexer.
+    def testCondition(directive, text, ln):
+        if directive in ["ifdef", "ifndef"]:
+            if not re.fullmatch(r"[a-z_.@][\w.@]*", text, re.ASCII | re.IGNORECASE): raise Exception("."+directive+" argument must be a label.")
+            return (text.lower() in VALUES or text.lower() in SETS) == (directive == "ifdef")
+        if not text: raise Exception("."+directive+" expected a condition.")
+        if text[0] != "{": text = "{"+text+"}"
+        cond, chread = Lexer.lexmath(text, False)
+        if chread != len(text): raise Exception("Expected comment, found '"+text[chread:]+"'.")
+        stack = []
+        for item in cond.code:
+            if type(item) is int: stack.append(item)
+            elif type(item) is str:
+                if item in ["@ip", "@sp"]: raise Exception(item+" is not a constant and can't be used in ."+directive+" conditions.")
+                if not isConstant(item): raise Exception("Symbol \""+item+"\" in ."+directive+" condition must be defined by .set before it.")
+                stack.append(resolve(item))
             else:
-                raise Exception("Unknown operator \""+str(op)+"\".")
+                op, argc = item
+                args = stack[len(stack)-argc:]
+                del stack[len(stack)-argc:]
+                if op in RELATIONAL: stack.append(int(RELATIONAL[op](*args)))
+                else: stack.append(mathop(op, args))
+        return stack[0] != 0
     
-    for line in lines:
+    for line in lex(testCondition):
+        if verbose: print(reprLine(line))
         try:
-            if line["label"]: # If there is a label
-                defSym(line["label"], _ip.s_value)
-            if line["cmd"]:
-                cmd = line["cmd"]
+            if INSTS and (line.label or line.cmd[0:1] == "."): encodeInsts()
+            if line.label: # If there is a label
+                defSym(line.label, _ip.s_value)
+            if line.cmd:
+                cmd = line.cmd
                 if cmd == ".global":
-                    for op in line["ops"]:
-                        if op["rtype"]: raise Exception("Registers are not allowed in .global")
-                        if op["ismem"]: raise Exception("Memory indexing is not allowed in .global")
-                        if op["itype"] != "lbl": raise Exception(".global argument must be a label.")
-                        if HASHTAB.containsName(file, op["ival"]):
-                            symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByName(file, op["ival"]))
-                            if symbol.s_info != Symbol.SINFO_LOCAL: raise Exception("Symbol \""+op["ival"]+"\" already has a non-local visibility.")
+                    for op in line.ops:
+                        if op.rtype: raise Exception("Registers are not allowed in .global")
+                        if op.ismem: raise Exception("Memory indexing is not allowed in .global")
+                        if op.itype != Operand.ITYPE_LBL: raise Exception(".global argument must be a label.")
+                        if HASHTAB.containsName(file, op.ival):
+                            symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByName(file, op.ival))
+                            if symbol.s_info != Symbol.SINFO_LOCAL: raise Exception("Symbol \""+op.ival+"\" already has a non-local visibility.")
                             symbol.s_info = Symbol.SINFO_GLOBAL
                         else:
-                            symbol = Symbol(SYMSTRTAB.getIDByString(op["ival"]), 0, Symbol.SINFO_GLOBAL, Symbol.SDEF_UNDEF)
-                            SYMTAB.addSymbol(file, symbol)
+                            symbol = Symbol(SYMSTRTAB.getIDByString(op.ival), 0, Symbol.SINFO_GLOBAL, Symbol.SDEF_UNDEF)
+                            UNDEFINED[SYMTAB.addSymbol(file, symbol)] = []
                 elif cmd == ".weak":
-                    for op in line["ops"]:
-                        if op["rtype"]: raise Exception("Registers are not allowed in .weak")
-                        if op["ismem"]: raise Exception("Memory indexing is not allowed in .weak")
-                        if op["itype"] != "lbl": raise Exception(".weak argument must be a label.")
-                        if HASHTAB.containsName(file, op["ival"]):
-                            symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByName(file, op["ival"]))
-                            if symbol.s_info != Symbol.SINFO_LOCAL: raise Exception("Symbol \""+op["ival"]+"\" already has a non-local visibility.")
+                    for op in line.ops:
+                        if op.rtype: raise Exception("Registers are not allowed in .weak")
+                        if op.ismem: raise Exception("Memory indexing is not allowed in .weak")
+                        if op.itype != Operand.ITYPE_LBL: raise Exception(".weak argument must be a label.")
+                        if HASHTAB.containsName(file, op.ival):
+                            symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByName(file, op.ival))
+                            if symbol.s_info != Symbol.SINFO_LOCAL: raise Exception("Symbol \""+op.ival+"\" already has a non-local visibility.")
                             symbol.s_info = Symbol.SINFO_WEAK
                         else:
-                            symbol = Symbol(SYMSTRTAB.getIDByString(op["ival"]), 0, Symbol.SINFO_WEAK, Symbol.SDEF_UNDEF)
-                            SYMTAB.addSymbol(file, symbol)
+                            symbol = Symbol(SYMSTRTAB.getIDByString(op.ival), 0, Symbol.SINFO_WEAK, Symbol.SDEF_UNDEF)
+                            UNDEFINED[SYMTAB.addSymbol(file, symbol)] = []
                 elif cmd == ".extern":
-                    for op in line["ops"]:
-                        if op["rtype"]: raise Exception("Registers are not allowed in .extern")
-                        if op["ismem"]: raise Exception("Memory indexing is not allowed in .extern")
-                        if op["itype"] != "lbl": raise Exception(".extern argument must be a label.")
-                        if HASHTAB.containsName(file, op["ival"]): raise Exception("Defined symbol \""+op["ival"]+"\" cannot be set to extern visiblity.")
-                        symbol = Symbol(SYMSTRTAB.getIDByString(op["ival"]), 0, Symbol.SINFO_EXTERN, Symbol.SDEF_UNDEF)
+                    for op in line.ops:
+                        if op.rtype: raise Exception("Registers are not allowed in .extern")
+                        if op.ismem: raise Exception("Memory indexing is not allowed in .extern")
+                        if op.itype != Operand.ITYPE_LBL: raise Exception(".extern argument must be a label.")
+                        if HASHTAB.containsName(file, op.ival): raise Exception("Defined symbol \""+op.ival+"\" cannot be set to extern visiblity.")
+                        symbol = Symbol(SYMSTRTAB.getIDByString(op.ival), 0, Symbol.SINFO_EXTERN, Symbol.SDEF_UNDEF)
                         SYMTAB.addSymbol(file, symbol)
                 elif cmd == ".set":
-                    if len(line["ops"]) != 2: raise Exception(".set expected 2 arguments, got "+str(len(line["ops"]))+".")
-                    name = line["ops"][0]
-                    value = line["ops"][1]
-                    if name["rtype"]: raise Exception(".set 1st argument cannot be a register.")
-                    if name["ismem"]: raise Exception(".set 1st argument cannot be a memory reference.")
-                    if name["itype"] != "lbl": raise Exception(".set 1st argument must be a label.")
-                    if value["rtype"]: raise Exception(".set 2nd argument cannot be a register.")
-                    if value["ismem"]: raise Exception(".set 2nd argument cannot be a memmory reference.")
-                    value = evalimm(value["ival"])
-                    if value["type"] != "abs": raise Exception(".set 2nd argument must be immediate or mexpr with all labels defined.")
-                    defSym(name["ival"], value["val"], Symbol.SDEF_ABS)
+                    if len(line.ops) != 2: raise Exception(".set expected 2 arguments, got "+str(len(line.ops))+".")
+                    name = line.ops[0]
+                    value = line.ops[1]
+                    if name.rtype: raise Exception(".set 1st argument cannot be a register.")
+                    if name.ismem: raise Exception(".set 1st argument cannot be a memory reference.")
+                    if name.itype != Operand.ITYPE_LBL: raise Exception(".set 1st argument must be a label.")
+                    if value.rtype: raise Exception(".set 2nd argument cannot be a register.")
+                    if value.ismem: raise Exception(".set 2nd argument cannot be a memmory reference.")
+                    value = evalimm(value.ival)
+                    if value["type"] == "abs":
+                        defSym(name.ival, value["val"], Symbol.SDEF_ABS)
+                        CONSTANTS.add(name.ival)
+                    elif name.ival in SETS or resolve(name.ival) is not None: raise Exception("Cannot redefine symbol \""+name.ival+"\".")
+                    else: SETS[name.ival] = (value["val"], line.ln) # Defined once the symbols it needs are
                 elif cmd == ".string":
                     if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
-                    for op in line["ops"]:
-                        if op["rtype"]: raise Exception("Registers are not allowed in .string")
-                        if op["ismem"]: raise Exception("Memory indexing is not allowed in .string")
-                        value = evalimm(op["ival"])
+                    for op in line.ops:
+                        if op.itype == Operand.ITYPE_DATA:
+                            appendWords(op.ival, ".string")
+                            continue
+                        if op.rtype: raise Exception("Registers are not allowed in .string")
+                        if op.ismem: raise Exception("Memory indexing is not allowed in .string")
+                        value = evalimm(op.ival)
                         if value["type"] != "abs": raise Exception(".string arguments must be defined.")
                         if not (-0x8000 <= value["val"] < 0x8000): raise Exception(".string arguments must be 16-bit.")
-                        CUR_SECTION.words.append(value["val"])
+                        CUR_SECTION.words.append(value["val"] & 0xFFFF)
                         _sp.s_value = CUR_SECTION.getSize()
                         _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                     CUR_SECTION.words.append(0)
                 elif cmd == ".dec":
                     if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
-                    for op in line["ops"]:
-                        if op["rtype"]: raise Exception("Registers are not allowed in .dec")
-                        if op["ismem"]: raise Exception("Memory indexing is not allowed in .dec")
-                        value = evalimm(op["ival"])
+                    for op in line.ops:
+                        if op.itype == Operand.ITYPE_DATA:
+                            appendWords(op.ival, ".dec")
+                            continue
+                        if op.rtype: raise Exception("Registers are not allowed in .dec")
+                        if op.ismem: raise Exception("Memory indexing is not allowed in .dec")
+                        value = evalimm(op.ival)
                         if value["type"] != "abs": raise Exception(".dec arguments must be defined.")
                         if not (-0x8000 <= value["val"] < 0x8000): raise Exception(".dec arguments must be 16-bit.")
-                        CUR_SECTION.words.append(value["val"])
+                        CUR_SECTION.words.append(value["val"] & 0xFFFF)
                         _sp.s_value = CUR_SECTION.getSize()
                         _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                 elif cmd == ".deca":
                     if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
-                    for op in line["ops"]:
-                        if op["rtype"]: raise Exception("Registers are not allowed in .deca")
-                        if op["ismem"]: raise Exception("Memory indexing is not allowed in .deca")
-                        value = evalimm(op["ival"])
+                    for op in line.ops:
+                        if op.itype == Operand.ITYPE_DATA:
+                            appendAddresses(op.ival)
+                            continue
+                        if op.rtype: raise Exception("Registers are not allowed in .deca")
+                        if op.ismem: raise Exception("Memory indexing is not allowed in .deca")
+                        value = evalimm(op.ival)
                         if value["type"] == "abs":
                             CUR_SECTION.words.extend([value["val"] & 0xFFFF, (value["val"] >> 16) & 0xFFFF])
                         elif value["type"] == "lbl":
@@ -257,93 +404,117 @@ def assemble(in_filepath, out_dirpath):
                             symbol = SYMTAB.getSymbolByID(reloc.r_symndx)
                             CUR_SECTION.words.extend([symbol.s_value & 0xFFFF, (symbol.s_value >> 16) & 0xFFFF])
                         elif value["type"] == "op":
-                            MEXPR_RELOCS.append({"offset": _sp.s_value, "line": line["ln"], "shndx": file.getIDBySection(CUR_SECTION), "mexpr":value})
+                            MEXPR_RELOCS.append({"offset": _sp.s_value, "line": line.ln, "shndx": file.getIDBySection(CUR_SECTION), "mexpr":value["val"]})
                             CUR_SECTION.words.extend([0, 0])
                         _sp.s_value = CUR_SECTION.getSize()
                         _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
+                elif cmd == ".incbin":
+                    if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
+                    if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
+                    if len(line.ops) > 3: raise Exception(".incbin expected 1 to 3 arguments, got "+str(len(line.ops))+".")
+                    bounds = []
+                    for nth, op in zip(["2nd", "3rd"], line.ops[1:]):
+                        if op.rtype: raise Exception(".incbin "+nth+" argument cannot be a register.")
+                        if op.ismem: raise Exception(".incbin "+nth+" argument cannot be a memory reference.")
+                        value = evalimm(op.ival)
+                        if value["type"] != "abs": raise Exception(".incbin "+nth+" argument must be defined.")
+                        if value["val"] < 0: raise Exception(".incbin "+nth+" argument must be a positive integer")
+                        bounds.append(value["val"])
+                    path = findBinary(line.ops[0].ival, directory)
+                    if binaries is None: CUR_SECTION.words.extend(readBinary(path, *bounds))
+                    else:
+                        key = (path, *bounds)
+                        if key not in binaries: binaries[key] = readBinary(path, *bounds)
+                        CUR_SECTION.words.extend(binaries[key])
+                    _sp.s_value = CUR_SECTION.getSize()
+                    _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                 elif cmd == ".pad":
                     if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
-                    if len(line["ops"]) != 2: raise Exception(".pad expected 2 arguments, got "+str(len(line["ops"]))+".")
-                    rep = line["ops"][0]
-                    value = line["ops"][1]
-                    if rep["rtype"]: raise Exception(".pad 1st argument cannot be a register.")
-                    if rep["ismem"]: raise Exception(".pad 1st argument cannot be a memory reference.")
-                    if value["rtype"]: raise Exception(".pad 2nd argument cannot be a register.")
-                    if value["ismem"]: raise Exception(".pad 2nd argument cannot be a memmory reference.")
-                    rep = evalimm(rep["ival"])
-                    value = evalimm(value["ival"])
+                    if len(line.ops) != 2: raise Exception(".pad expected 2 arguments, got "+str(len(line.ops))+".")
+                    rep = line.ops[0]
+                    value = line.ops[1]
+                    if rep.rtype: raise Exception(".pad 1st argument cannot be a register.")
+                    if rep.ismem: raise Exception(".pad 1st argument cannot be a memory reference.")
+                    if value.rtype: raise Exception(".pad 2nd argument cannot be a register.")
+                    if value.ismem: raise Exception(".pad 2nd argument cannot be a memmory reference.")
+                    rep = evalimm(rep.ival)
+                    value = evalimm(value.ival)
                     if rep["type"] != "abs": raise Exception(".pad 1st argument must be defined.")
                     if rep["val"] < 0: raise Exception(".pad 1st argument must be a positive integer")
                     if value["type"] != "abs": raise Exception(".pad 2nd argument must be defined.")
                     if not (-0x8000 <= value["val"] < 0x8000): raise Exception(".pad 2nd argument must be 16-bit.")
-                    for i in range(rep["val"]):
-                        CUR_SECTION.words.append(value["val"])
+                    if rep["val"]:
+                        CUR_SECTION.words.extend(array("H", [value["val"] & 0xFFFF]) * rep["val"])
                         _sp.s_value = CUR_SECTION.getSize()
                         _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                 elif cmd == ".pada":
                     if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
-                    if len(line["ops"]) != 2: raise Exception(".pada expected 2 arguments, got "+str(len(line["ops"]))+".")
-                    rep = line["ops"][0]
-                    value = line["ops"][1]
-                    if rep["rtype"]: raise Exception(".pada 1st argument cannot be a register.")
-                    if rep["ismem"]: raise Exception(".pada 1st argument cannot be a memory reference.")
-                    if value["rtype"]: raise Exception(".pada 2nd argument cannot be a register.")
-                    if value["ismem"]: raise Exception(".pada 2nd argument cannot be a memmory reference.")
-                    rep = evalimm(rep["ival"])
-                    value = evalimm(value["ival"])
+                    if len(line.ops) != 2: raise Exception(".pada expected 2 arguments, got "+str(len(line.ops))+".")
+                    rep = line.ops[0]
+                    value = line.ops[1]
+                    if rep.rtype: raise Exception(".pada 1st argument cannot be a register.")
+                    if rep.ismem: raise Exception(".pada 1st argument cannot be a memory reference.")
+                    if value.rtype: raise Exception(".pada 2nd argument cannot be a register.")
+                    if value.ismem: raise Exception(".pada 2nd argument cannot be a memmory reference.")
+                    rep = evalimm(rep.ival)
+                    value = evalimm(value.ival)
                     if rep["type"] != "abs": raise Exception(".pad 1st argument must be defined.")
                     if rep["val"] < 0: raise Exception(".pad 1st argument must be a positive integer")
-                    for i in range(rep["val"]):
-                        if value["type"] == "abs":
-                            CUR_SECTION.words.extend([value["val"] & 0xFFFF, (value["val"] >> 16) & 0xFFFF])
-                        elif value["type"] == "lbl":
-                            symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByString(value["val"]))
-                            if symbol.s_shndx != Symbol.SDEF_ABS:
-                                reloc = defRel(value["val"], _sp.s_value)
-                            CUR_SECTION.words.extend([symbol.s_value & 0xFFFF, (symbol.s_value >> 16) & 0xFFFF])
-                        elif value["type"] == "op":
-                            MEXPR_RELOCS.append({"offset": _sp.s_value, "line": line["ln"], "shndx": file.getIDBySection(CUR_SECTION), "mexpr":value})
-                            CUR_SECTION.words.extend([0, 0])
-                        _sp.s_value = CUR_SECTION.getSize()
-                        _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
+                    if value["type"] == "abs":
+                        if rep["val"]:
+                            CUR_SECTION.words.extend(array("H", [value["val"] & 0xFFFF, (value["val"] >> 16) & 0xFFFF]) * rep["val"])
+                            _sp.s_value = CUR_SECTION.getSize()
+                            _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
+                    else: # Every copy of a symbol or mexpr needs its own relocation
+                        for i in range(rep["val"]):
+                            if value["type"] == "lbl":
+                                symbol = SYMTAB.getSymbolByID(HASHTAB.getSymbolIDByString(value["val"]))
+                                if symbol.s_shndx != Symbol.SDEF_ABS:
+                                    reloc = defRel(value["val"], _sp.s_value)
+                                CUR_SECTION.words.extend([symbol.s_value & 0xFFFF, (symbol.s_value >> 16) & 0xFFFF])
+                            elif value["type"] == "op":
+                                MEXPR_RELOCS.append({"offset": _sp.s_value, "line": line.ln, "shndx": file.getIDBySection(CUR_SECTION), "mexpr":value["val"]})
+                                CUR_SECTION.words.extend([0, 0])
+                            _sp.s_value = CUR_SECTION.getSize()
+                            _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                 elif cmd == ".res":
                     if not CUR_SECTION: raise Exception("Section must be defined when declaring data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_NOBITS: raise Exception(".res can only be used in NOBITS sections.")
-                    if len(line["ops"]) != 1: raise Exception(".res expected 1 argument, got "+str(len(line["ops"]))+".")
-                    rep = line["ops"][0]
-                    if rep["rtype"]: raise Exception(".res 1st argument cannot be a register.")
-                    if rep["ismem"]: raise Exception(".res 1st argument cannot be a memory reference.")
-                    rep = evalimm(rep["ival"])
+                    if len(line.ops) != 1: raise Exception(".res expected 1 argument, got "+str(len(line.ops))+".")
+                    rep = line.ops[0]
+                    if rep.rtype: raise Exception(".res 1st argument cannot be a register.")
+                    if rep.ismem: raise Exception(".res 1st argument cannot be a memory reference.")
+                    rep = evalimm(rep.ival)
                     if rep["type"] != "abs": raise Exception(".res 1st argument must be defined.")
                     if rep["val"] < 0: raise Exception(".res 1st argument must be a positive integer")
-                    for i in range(rep["val"]):
-                        CUR_SECTION.words.append(0)
+                    if rep["val"]:
+                        CUR_SECTION.size += rep["val"]
                         _sp.s_value = CUR_SECTION.getSize()
                         _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                 elif cmd == ".resa":
                     if not CUR_SECTION: raise Exception("Section must be defined when declaring data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_NOBITS: raise Exception(".resa can only be used in NOBITS sections.")
-                    if len(line["ops"]) != 1: raise Exception(".resa expected 1 argument, got "+str(len(line["ops"]))+".")
-                    rep = line["ops"][0]
-                    if rep["rtype"]: raise Exception(".resa 1st argument cannot be a register.")
-                    if rep["ismem"]: raise Exception(".resa 1st argument cannot be a memory reference.")
-                    rep = evalimm(rep["ival"])
+                    if len(line.ops) != 1: raise Exception(".resa expected 1 argument, got "+str(len(line.ops))+".")
+                    rep = line.ops[0]
+                    if rep.rtype: raise Exception(".resa 1st argument cannot be a register.")
+                    if rep.ismem: raise Exception(".resa 1st argument cannot be a memory reference.")
+                    rep = evalimm(rep.ival)
                     if rep["type"] != "abs": raise Exception(".resa 1st argument must be defined.")
                     if rep["val"] < 0: raise Exception(".resa 1st argument must be a positive integer")
-                    for i in range(rep["val"]):
-                        CUR_SECTION.words.extend([0, 0])
+                    if rep["val"]:
+                        CUR_SECTION.size += 2*rep["val"]
                         _sp.s_value = CUR_SECTION.getSize()
                         _ip.s_value = _sp.s_value + CUR_SECTION_HDR.sh_addr
                 elif cmd == ".org":
                     if not CUR_SECTION: raise Exception("Section must be defined to set its origin.")
                     if CUR_SECTION.getSize() != 0: raise Exception(".org can only be used at the beginning of a section.")
-                    if len(line["ops"]) != 1: raise Exception(".org expected 1 argument, got "+str(len(line["ops"]))+".")
-                    addr = line["ops"][0]
-                    if addr["rtype"]: raise Exception(".org 1st argument cannot be a register.")
-                    if addr["ismem"]: raise Exception(".org 1st argument cannot be a memory reference.")
-                    addr = evalimm(addr["ival"])
+                    if len(line.ops) != 1: raise Exception(".org expected 1 argument, got "+str(len(line.ops))+".")
+                    addr = line.ops[0]
+                    if addr.rtype: raise Exception(".org 1st argument cannot be a register.")
+                    if addr.ismem: raise Exception(".org 1st argument cannot be a memory reference.")
+                    addr = evalimm(addr.ival)
                     if addr["type"] != "abs": raise Exception(".org 1st argument must be defined.")
                     if addr["val"] < _ip.s_value: raise Exception(".org cannot be used to recede backwards. (@ip="+str(_ip.s_value)+", addr="+str(rep["val"])+").")
                     _ip.s_value = addr["val"]
@@ -351,15 +522,15 @@ def assemble(in_filepath, out_dirpath):
                     CUR_SECTION_HDR.sh_addr = _ip.s_value
                 elif cmd == ".align":
                     if not CUR_SECTION: raise Exception("Section must be defined when defining data.")
-                    if len(line["ops"]) != 2: raise Exception(".align expected 2 arguments, got "+str(len(line["ops"]))+".")
-                    boundary = line["ops"][0]
-                    value = line["ops"][0]
-                    if boundary["rtype"]: raise Exception(".align 1st argument cannot be a register.")
-                    if boundary["ismem"]: raise Exception(".align 1st argument cannot be a memory reference.")
-                    if value["rtype"]: raise Exception(".align 2nd argument cannot be a register.")
-                    if value["ismem"]: raise Exception(".align 2nd argument cannot be a memmory reference.")
-                    boundary = evalimm(boundary["ival"])
-                    value = evalimm(value["ival"])
+                    if len(line.ops) != 2: raise Exception(".align expected 2 arguments, got "+str(len(line.ops))+".")
+                    boundary = line.ops[0]
+                    value = line.ops[0]
+                    if boundary.rtype: raise Exception(".align 1st argument cannot be a register.")
+                    if boundary.ismem: raise Exception(".align 1st argument cannot be a memory reference.")
+                    if value.rtype: raise Exception(".align 2nd argument cannot be a register.")
+                    if value.ismem: raise Exception(".align 2nd argument cannot be a memmory reference.")
+                    boundary = evalimm(boundary.ival)
+                    value = evalimm(value.ival)
                     if rep["type"] != "abs": raise Exception(".align 1st argument must be defined.")
                     if rep["val"] < 0: raise Exception(".align 1st argument must be a positive integer")
                     if value["type"] != "abs": raise Exception(".align 2nd argument must be defined.")
@@ -368,33 +539,35 @@ def assemble(in_filepath, out_dirpath):
                     CUR_SECTION.words.extend([0]*rep)
                     _ip.s_value += rep
                 elif cmd == ".section":
-                    if len(line["ops"]) != 2: raise Exception(".section expected 2 arguments, got "+str(len(line["ops"]))+".")
-                    name = line["ops"][0]
-                    value = line["ops"][1]
-                    if name["rtype"]: raise Exception(".section 1st argument cannot be a register.")
-                    if name["ismem"]: raise Exception(".section 1st argument cannot be a memory reference.")
-                    if name["itype"] != "lbl": raise Exception(".section 1st argument must be a label.")
-                    if name["ival"].startswith("@"): raise Exception("@ symbol is reserved for assembler-defined sections.")
-                    if SHSTRTAB.containsString(name["ival"]): raise Exception("Section \""+name["ival"]+"\" already exists.")
-                    if value["rtype"]: raise Exception(".section 2nd argument cannot be a register.")
-                    if value["ismem"]: raise Exception(".section 2nd argument cannot be a memmory reference.")
-                    value = evalimm(value["ival"])
+                    if len(line.ops) != 2: raise Exception(".section expected 2 arguments, got "+str(len(line.ops))+".")
+                    name = line.ops[0]
+                    value = line.ops[1]
+                    if name.rtype: raise Exception(".section 1st argument cannot be a register.")
+                    if name.ismem: raise Exception(".section 1st argument cannot be a memory reference.")
+                    if name.itype != Operand.ITYPE_LBL: raise Exception(".section 1st argument must be a label.")
+                    if name.ival.startswith("@"): raise Exception("@ symbol is reserved for assembler-defined sections.")
+                    if SHSTRTAB.containsString(name.ival): raise Exception("Section \""+name.ival+"\" already exists.")
+                    if value.rtype: raise Exception(".section 2nd argument cannot be a register.")
+                    if value.ismem: raise Exception(".section 2nd argument cannot be a memmory reference.")
+                    value = evalimm(value.ival)
                     if value["type"] != "abs": raise Exception(".section 2nd argument must be defined.")
                     isImaged = value["val"] & 1 != 0
                     isAlloc = value["val"] & 2 != 0
-                    CUR_SECTION_HDR = SectionHeader(SHSTRTAB.getIDByString(name["ival"]),
+                    CUR_SECTION_HDR = SectionHeader(SHSTRTAB.getIDByString(name.ival),
                                            SectionHeader.SHTYPE_PROGDAT if isImaged else SectionHeader.SHTYPE_NOBITS,
                                            _ip.s_value if isAlloc else 0,
                                            -1, -1, 0,
                                            0xEF00 if isImaged else 0,
                                            0, 0)
-                    CUR_SECTION = GeneralSection()
+                    CUR_SECTION = GeneralSection() if isImaged else NobitsSection()
                     file.addSection(CUR_SECTION_HDR, CUR_SECTION)
                     REL_SECTION_HDR = None
                     REL_SECTION = None
                     _sp.s_value = _ip.s_value
+                elif cmd in [".if", ".ifdef", ".ifndef", ".elif", ".else", ".endif"]:
+                    raise Exception("Conditional directives cannot have a label.")
                 elif cmd == ".text":
-                    if len(line["ops"]) != 0: raise Exception(".text expected 0 arguments, got "+str(len(line["ops"]))+".")
+                    if len(line.ops) != 0: raise Exception(".text expected 0 arguments, got "+str(len(line.ops))+".")
                     if SHSTRTAB.containsString("text"): raise Exception("text section already exists.")
                     CUR_SECTION_HDR = SectionHeader(SHSTRTAB.getIDByString("text"), SectionHeader.SHTYPE_PROGDAT, _ip.s_value, -1, -1, 0, 0xEF00, 0, 0)
                     CUR_SECTION = GeneralSection()
@@ -403,7 +576,7 @@ def assemble(in_filepath, out_dirpath):
                     REL_SECTION = None
                     _sp.s_value = _ip.s_value
                 elif cmd == ".data":
-                    if len(line["ops"]) != 0: raise Exception(".data expected 0 arguments, got "+str(len(line["ops"]))+".")
+                    if len(line.ops) != 0: raise Exception(".data expected 0 arguments, got "+str(len(line.ops))+".")
                     if SHSTRTAB.containsString("data"): raise Exception("data section already exists.")
                     CUR_SECTION_HDR = SectionHeader(SHSTRTAB.getIDByString("data"), SectionHeader.SHTYPE_PROGDAT, _ip.s_value, -1, -1, 0, 0x0000, 0, 0)
                     CUR_SECTION = GeneralSection()
@@ -412,10 +585,10 @@ def assemble(in_filepath, out_dirpath):
                     REL_SECTION = None
                     _sp.s_value = _ip.s_value
                 elif cmd == ".bss":
-                    if len(line["ops"]) != 0: raise Exception(".bss expected 0 arguments, got "+str(len(line["ops"]))+".")
+                    if len(line.ops) != 0: raise Exception(".bss expected 0 arguments, got "+str(len(line.ops))+".")
                     if SHSTRTAB.containsString("bss"): raise Exception("bss section already exists.")
                     CUR_SECTION_HDR = SectionHeader(SHSTRTAB.getIDByString("bss"), SectionHeader.SHTYPE_NOBITS, _ip.s_value, -1, -1, 0, 0xEF00, 0, 0)
-                    CUR_SECTION = GeneralSection()
+                    CUR_SECTION = NobitsSection()
                     file.addSection(CUR_SECTION_HDR, CUR_SECTION)
                     REL_SECTION_HDR = None
                     REL_SECTION = None
@@ -423,55 +596,199 @@ def assemble(in_filepath, out_dirpath):
                 else:
                     if not CUR_SECTION: raise Exception("Section must be defined when writing data.")
                     if CUR_SECTION_HDR.sh_type != SectionHeader.SHTYPE_PROGDAT: raise Exception("Cannot write to non-PROGDAT section.")
-                    ret, relocs = matchInst(cmd, line["ops"])
-                    for reloc in relocs:
-                        if line["ops"][reloc["opN"]]["itype"] == "mexpr":
-                            MEXPR_RELOCS.append({"offset": _ip.s_value - _sp.s_value + reloc["offset"],
-                                                 "line": line["ln"],
+                    encode = findInst(cmd, line.ops)
+                    ops = line.ops
+                    if encode in shortforms and isShrinkable(ops[shortforms[encode][0]]):
+                        n, short, slot = shortforms[encode]
+                        SHRINKABLE.append(ops[n])
+                        if len(SHRINKABLE)-1 not in widen:
+                            # Encoded alone with a placeholder, the offset is written once it is known
+                            encodeInsts()
+                            ops = list(ops)
+                            ops[n] = Operand(ops[n].rtype, Operand.ITYPE_ABS, ops[n].ismem, ops[n].rval, 0)
+                            MEXPR_RELOCS.append({"offset": CUR_SECTION.getSize() + slot,
+                                                 "line": line.ln,
                                                  "shndx": file.getIDBySection(CUR_SECTION),
-                                                 "mexpr": line["ops"][reloc["opN"]]["ival"]})
-                        elif line["ops"][reloc["opN"]]["itype"] == "lbl":
-                            relobj = defRel(line["ops"][reloc["opN"]]["ival"], _ip.s_value - _sp.s_value + reloc["offset"])
-                            symbol = SYMTAB.getSymbolByID(relobj.r_symndx)
-                            ret[reloc["offset"]] = symbol.s_value & 0xFFFF
-                            ret[reloc["offset"]+1] = (symbol.s_value >> 16) & 0xFFFF
-                    CUR_SECTION.words.extend(ret)
-                    _ip.s_value += len(ret)
+                                                 "mexpr": line.ops[n].ival,
+                                                 "width": 1})
+                            encode = short
+                    # @ip and @sp are read when the batch is encoded, so their value is the one at the start of it
+                    if INSTS and any(op.itype == Operand.ITYPE_LBL and op.ival in ["@ip", "@sp"] for op in ops): encodeInsts()
+                    INSTS.append((encode, ops))
+                    INST_LINES.append(line.ln)
+                    if len(INSTS) >= INST_BATCH: encodeInsts()
         except Exception as e:
-            print("$ - (ERROR) " + str(line["ln"]) + " - " + str(e))
-            exit(-1)
+            raise AssemblyError(str(e), line.ln) from e
     
+    if INSTS: encodeInsts()
+    defineSets()
+    fits = []
+    for op in SHRINKABLE:
+        if op.itype == Operand.ITYPE_LBL:
+            fits.append(isConstant(op.ival) and fitsOffset16(resolve(op.ival)))
+        else:
+            value = evaldeferred(op.ival)
+            fits.append(value["type"] == "abs" and fitsOffset16(value["val"]))
+    if not all(fits[i] for i in range(len(fits)) if i not in widen): return None, fits
+    if verbose: print("$ - Verifying symbols")
+    for symid in UNDEFINED:
+        raise AssemblyError("Non-extern symbol \""+SYMSTRTAB.getStringByID(SYMTAB.getSymbolByID(symid).s_name)+"\" is undefined.")  
+    if verbose:
+        print("$ - Symbols verified")
+        print("$ - Resolving math expressions")
+    for mexprrel in MEXPR_RELOCS:
+        val = evaldeferred(mexprrel["mexpr"])
+        if val["type"] != "abs": raise AssemblyError("Math expression \""+reprMath(mexprrel["mexpr"])+"\" couldn't be evaluated to an absolute value.", mexprrel["line"])
+        _, section = file.getSection(mexprrel["shndx"])
+        section.words[mexprrel["offset"]] = val["val"] & 0xFFFF
+        if mexprrel.get("width") == 1: continue
+        section.words[mexprrel["offset"]+1] = (val["val"] >> 16) & 0xFFFF
+    if verbose:
+        print("$ - "+str(len(MEXPR_RELOCS))+" math expressions solved")
+        print("$ - Translation complete")
+    return file, fits
+
+# Picks the shortest encoding of every shrinkable offset: all of them start at 16 bits and
+# the ones that don't fit are widened until a translation succeeds. Offsets are never
+# shrunk back, so this always terminates. lex(condition) returns the lexed lines of the
+# source. The first translation streams them, and only if it has to be done again are the
+# lines and .incbin files of the second one kept, to be replayed by the ones after it
+# (their conditional blocks are not tested again). The verbose listing of a translation
+# is only printed if it is the last one. Every error is raised as an AssemblyError.
+def assembleLines(lex, filename, directory=None):
+    if directory is None: directory = os.path.dirname(filename)
+    widen = set()
+    binaries, lexed = None, None
+    source = lex
+    def record(condition):
+        for line in source(condition):
+            lexed.append(line)
+            yield line
     try:
-        if verbose: print("$ - Verifying symbols")
-        for symbol in SYMTAB.symbols:
-            if symbol.s_shndx == Symbol.SDEF_UNDEF and symbol.s_info != Symbol.SINFO_EXTERN:
-                raise Exception("Non-extern symbol \""+SYMSTRTAB.getStringByID(symbol.s_name)+"\" is undefined.")  
-        if verbose:
-            print("$ - Symbols verified")
-            print("$ - Resolving math expressions")
-        for mexprrel in MEXPR_RELOCS:
-            val = evalimm(mexprrel["mexpr"])
-            if val["type"] != "abs": raise Exception(str(mexprrel["line"]) + " - Math expression \""+reprMath(val)+"\" couldn't be evaluated to an absolute value.")
-            _, section = file.getSection(mexprrel["shndx"])
-            section.words[mexprrel["offset"]] = val["val"] & 0xFFFF
-            section.words[mexprrel["offset"]+1] = (val["val"] >> 16) & 0xFFFF
-        if verbose:
-            print("$ - "+str(len(MEXPR_RELOCS))+" math expressions solved")
-            print("$ - Translation complete")
+        while True:
+            listing = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(listing):
+                    file, fits = translate(lex, widen, directory, binaries)
+            except Exception:
+                sys.stdout.write(listing.getvalue()) # The listing up to the error
+                raise
+            if file:
+                sys.stdout.write(listing.getvalue())
+                return file
+            widen |= {i for i in range(len(fits)) if not fits[i]}
+            if verbose: print("$ - "+str(len(widen))+" offsets need 32 bits, translating again")
+            if lexed is None:
+                binaries, lexed = {}, []
+                lex = record
+            else: lex = lambda condition: lexed
+    except AssemblyError as e:
+        if e.filename is None: e.filename = filename
+        raise
+    except LexError as e:
+        raise AssemblyError(e.message, e.ln, filename) from e
     except Exception as e:
-        print("$ - (ERROR) " + str(e))
-        exit(-1)
+        raise AssemblyError(str(e), None, filename) from e
+
+# Yields the (line number, text) lines of the preprocessor as they come
+def preprocessed(run):
+    try:
+        yield from run(Preprocessor(includedirs, defines, headers))
+    except PreprocessError as e:
+        raise AssemblyError(e.message, e.ln, e.filename) from e
+    if headers.added and headers.filepath: headers.save()
+
+# Runs the preprocessor over source text and returns its (line number, text) lines.
+# #include paths are searched from directory (Default: the directory of filename).
+def preprocess_text(text, filename="<text>", directory=None):
+    return list(preprocessed(lambda pp: pp.itertext(text, filename, directory)))
+
+def preprocess_file(in_filepath):
+    return list(preprocessed(lambda pp: pp.iterfile(in_filepath)))
+
+# What the object of preprocessed lines depends on, with the lexer engine: their text and
+# the contents of the files they .incbin, searched from directory
+def preprocessedSource(lines, directory=""):
+    source = "\n".join(text for _, text in lines).encode()
+    for m in _INCBIN.finditer(source.decode()):
+        try:
+            path = findBinary(re.sub(r"\\(.)", r"\1", m.group(1)[1:-1]), directory)
+        except Exception:
+            continue # Reported when assembling
+        with open(path, "rb") as f:
+            source += b"\0" + path.encode() + b"\0" + hashlib.sha256(f.read()).digest()
+    return source
+
+# Assembles the preprocessed lines that numbered() returns into an object, lexing them in
+# parallel with -j if asked to. .incbin files are searched from directory (Default: the
+# directory of filename).
+def assembleNumbered(numbered, filename, parallel=False, directory=None):
+    if parallel: return assembleLines(lambda condition: Lexer.iterparallel(numbered(), lexengine == "fast", jobs, condition), filename, directory)
+    return assembleLines(lambda condition: Lexer.iternumbered(numbered(), lexengine == "fast", condition), filename, directory)
+
+# Assembles preprocessed lines into an object, lexing them in parallel with -j if asked to.
+# .incbin files are searched from directory (Default: the directory of filename).
+def assemble_preprocessed(lines, filename, parallel=False, directory=None):
+    return assembleNumbered(lambda: lines, filename, parallel, directory)
+
+# Assembles source text into an object, without touching the disk.
+# SLBFManager.serializeBytes gives the bytes of the returned object.
+def assemble_text(text, filename="<text>", directory=None):
+    return assembleNumbered(lambda: preprocessed(lambda pp: pp.itertext(text, filename, directory)), filename, False, directory)
 
+# Assembles a source file into an object, streaming it from the preprocessor to the lexer.
+# Large files are lexed in parallel with -j.
+def assemble_file(in_filepath):
+    return assembleNumbered(lambda: preprocessed(lambda pp: pp.iterfile(in_filepath)), in_filepath, jobs > 1 and os.path.getsize(in_filepath) >= Lexer.PARALLEL_MINSIZE)
+
+def assemble(in_filepath, out_dirpath):
+    if verbose: print("[FILE] "+in_filepath)
     out_filepath = os.path.splitext(os.path.basename(in_filepath))[0] + outext
     out_filepath = os.path.join(out_dirpath, out_filepath)
+    if cache:
+        # The key needs the whole preprocessed source, which is kept to assemble it on a miss
+        lines = preprocess_file(in_filepath)
+        key = cache.key(preprocessedSource(lines, os.path.dirname(in_filepath)), (lexengine,))
+        if cache.get(key, out_filepath):
+            print("$ - (SUCCESS) "+in_filepath+" -> "+out_filepath+" (cached)")
+            return
+        file = assemble_preprocessed(lines, in_filepath, jobs > 1 and os.path.getsize(in_filepath) >= Lexer.PARALLEL_MINSIZE)
+    else: file = assemble_file(in_filepath)
     with open(out_filepath, "wb") as f:
         f.write(SLBFManager.serializeBytes(file))
+    if cache: cache.put(key, out_filepath)
     print("$ - (SUCCESS) "+in_filepath+" -> "+out_filepath)
 
+# Assembles a file, reporting an error instead of raising it. Returns whether it succeeded.
+def tryAssemble(in_filepath, out_dirpath):
+    try:
+        assemble(in_filepath, out_dirpath)
+        return True
+    except AssemblyError as e:
+        print("$ - (ERROR) "+str(e).split("\n")[0])
+        return False
+    except Exception as e:
+        print("$ - (ERROR) "+in_filepath+": "+str(e).split("\n")[0])
+        return False
+
+# Runs tryAssemble in a worker process with the options of the main process, lexing serially.
+# Output is captured so that it can be printed in the order files were given, and
+# cache hits and misses are returned to be counted by the main process.
+def _assembleworker(in_filepath, out_dirpath, options):
+    global verbose, outext, lexengine, jobs, cache, includedirs, defines, headers
+    verbose, outext, lexengine, cache, includedirs, defines, pchpath = options
+    jobs = 1
+    if headers.filepath != pchpath: headers = HeaderCache(pchpath)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        ok = tryAssemble(in_filepath, out_dirpath)
+    return ok, out.getvalue(), (cache.hits, cache.misses) if cache else (0, 0)
+
 def main(argv):
-    opts, args = getopt.getopt(argv, "d:hv", ["help", "verbose"])
+    opts, args = getopt.getopt(argv, "d:hj:vI:D:", ["help", "verbose", "lexer=", "cache=", "cache-size=", "cache-stats", "pch="])
     files = []
-    global verbose, outdir
+    global verbose, outdir, lexengine, jobs, cache, headers
+    cachedir, cachesize, cachestats = None, 512, False
     
     for o, a in opts:
         if o in ["-h", "--help"]:
@@ -480,16 +797,55 @@ def main(argv):
             print("Options:")
             print("\t-h | --help: Display this message.")
             print("\t-v | --verbose: Display extra information on the assembling process.")
+            print("\t--lexer=ENGINE: Use the \"fast\" single-pass tokenizer (Default) or the \"legacy\" one.")
+            print("\t-j N: Assemble up to N files at once in worker processes. A single file is lexed in N workers instead if it is over "+str(Lexer.PARALLEL_MINSIZE//1024)+" KiB.")
+            print("\t--cache=DIR: Copy the objects of files assembled before from the cache in DIR instead of assembling them.")
+            print("\t--cache-size=MIB: Evict least recently used objects until the cache fits in MIB MiB (Default 512).")
+            print("\t--cache-stats: Display the cache statistics after assembling.")
+            print("\t-I DIR: Search DIR for #include files after the directory of the including file.")
+            print("\t-D NAME[=VALUE]: Define the preprocessor symbol NAME as VALUE (Default 1).")
+            print("\t--pch=FILE: Keep precompiled #include files in FILE, shared between runs and workers.")
             print("\t-d OUTPUT: Specify OUTPUT as the output directory. Creates OUTPUT if it does not exist. Must not be a file.\n")
             print("\tfile... is a list of assembly files to compile.\n")
             exit(0)
         if o in ["-v", "--verbose"]:
             verbose = True
+        if o == "--lexer":
+            if a not in ["fast", "legacy"]:
+                print("[FATAL] Unknown lexer \""+a+"\". Expected \"fast\" or \"legacy\".")
+                exit(-1)
+            lexengine = a
+        if o == "-j":
+            if not a.isdigit() or int(a) < 1:
+                print("[FATAL] Invalid job count \""+a+"\". Expected a positive integer.")
+                exit(-1)
+            jobs = int(a)
         if o == "-d":
             if os.path.isfile(a):
                 print("[WARNING] Specified output directory \""+a+"\" is already an existing file.")
                 continue
             outdir = a
+        if o == "--cache":
+            cachedir = a
+        if o == "--cache-size":
+            if not a.isdigit():
+                print("[FATAL] Invalid cache size \""+a+"\". Expected a number of MiB.")
+                exit(-1)
+            cachesize = int(a)
+        if o == "--cache-stats":
+            cachestats = True
+        if o == "-I":
+            includedirs.append(a)
+        if o == "-D":
+            name, _, value = a.partition("=")
+            defines[name] = value if _ else "1"
+        if o == "--pch":
+            headers = HeaderCache(a)
+    if cachedir:
+        if os.path.isfile(cachedir):
+            print("[FATAL] Specified cache directory \""+cachedir+"\" is an existing file.")
+            exit(-1)
+        cache = ObjectCache(cachedir, cachesize << 20)
     if not outdir:
         print("[WARNING] Valid output directory was not specified. Defaulting to current directory")
         outdir = "."
@@ -504,12 +860,26 @@ def main(argv):
         print("[FATAL] No files to assemble.")
         exit(-1)
     
-    for in_filepath in files:
-        try:
-            assemble(in_filepath, outdir)
-        except Exception as e:
-            print("[FATAL]", os.path.basename(in_filepath)+":"+e.args[0].split("\n")[0])
-            
+    failed = 0
+    if jobs > 1 and len(files) > 1:
+        with ProcessPoolExecutor(min(jobs, len(files))) as pool:
+            for ok, output, (hits, misses) in pool.map(_assembleworker, files, repeat(outdir), repeat((verbose, outext, lexengine, cache, includedirs, defines, headers.filepath))):
+                print(output, end="")
+                if not ok: failed += 1
+                if cache:
+                    cache.hits += hits
+                    cache.misses += misses
+    else:
+        for in_filepath in files:
+            if not tryAssemble(in_filepath, outdir): failed += 1
+    if cache:
+        cache.saveStats()
+        cache.evict()
+        if cachestats: print(cache.reprStats())
+    if failed:
+        print("[FATAL] "+str(failed)+" of "+str(len(files))+" files failed to assemble.")
+        exit(-1)
+
 
 if __name__ == "__main__":
     main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,116 @@
+from opdb import db, condcodes
+from SLBFManager import SectionHeader
+
+regid = "ABCDEGMLXYSPUVFZ"
+ccnames = [None] * 16
+for names, cc in condcodes.items(): ccnames[cc] = names.split("|")[0]
+
+def reprReg(rval, r32):
+    return "%" + (regid[rval ^ 0b0001] + regid[rval] if r32 else regid[rval])
+
+def reprImm(value):
+    return str(value) if value < 10 else "0{:X}h".format(value)
+
+# A descriptor from opdb.db, flattened so that decoding an instruction only reads
+# its words. Each operand is (class, register shift, 32-bit register mask, immediate offset, immediate width).
+class Form:
+    __slots__ = ("name", "cc", "mask", "bits", "size", "ops")
+
+    def __init__(self, descriptor, name):
+        self.name = name
+        self.cc = "rcc" in descriptor[3]
+        self.ops = []
+        self.size = 1
+        offsets = {} # Immediates follow the opcode word in flag order
+        for flag in descriptor[3]:
+            if flag[0:2] in ["iw", "id"]:
+                offsets[flag[2:]] = (self.size, 1 if flag[0:2] == "iw" else 2)
+                self.size += offsets[flag[2:]][1]
+        free = 0x0F if self.cc else 0xFF # Bits of the low byte not written by an operand
+        for n, opc in enumerate(descriptor[1]):
+            shift, r32 = None, None
+            offset, width = offsets.get(str(n), (None, 0))
+            for flag in descriptor[3]:
+                if flag == "mvm":
+                    shift, r32 = (4, 0x0200) if n == 0 else (0, 0x0100)
+                elif flag[2:] != str(n): continue
+                elif flag[0:2] in ["rS", "aS"]: shift = 4
+                elif flag[0:2] in ["rD", "aD"]: shift = 0
+                if flag[0:2] in ["aS", "aD"]: r32 = 0x0100
+            if shift is not None: free &= ~(0x0F << shift)
+            self.ops.append((opc, shift, r32, offset, width))
+        # Unused bits are always zero, except in implicit stack pointer forms
+        # which share their opcode with the explicit ones
+        self.mask, self.bits = free, 0xBB & free if "rsp" in descriptor[3] else 0
+
+    def decode(self, words, i, relocs):
+        w = words[i]
+        name = "j" + ccnames[(w >> 4) & 0x0F] if self.cc else self.name
+        ops = []
+        for opc, shift, r32, offset, width in self.ops:
+            rval = (w >> shift) & 0x0F if shift is not None else 0
+            if offset is None: imm = None
+            elif i + offset in relocs: imm = relocs[i + offset]
+            elif width == 1: imm = reprImm(words[i + offset])
+            else: imm = reprImm(words[i + offset] | (words[i + offset + 1] << 16))
+            if opc in ["imm", "imm16", "imm32"]: ops.append(imm or "0")
+            elif opc == "reg": ops.append(reprReg(rval, True))
+            else:
+                reg = reprReg(rval, opc == "reg32" or bool(r32 and w & r32))
+                if imm is not None: reg = imm if reg == "%Z" else reg + "+" + imm
+                ops.append("$(" + reg + ")" if opc[0:3] == "mem" else reg)
+        return name + (" " + ", ".join(ops) if ops else "")
+
+# The classes the assembler can tell apart when picking a form
+def kinds(classes):
+    return [opc[0:3] if opc[0:3] == "imm" else opc for opc in classes]
+
+# Maps every opcode byte to the forms encoded with it, in db order.
+# Mnemonics are picked so that reassembling the output selects the same form.
+def buildTable():
+    table = [()] * 256
+    for k, descriptor in enumerate(db):
+        if descriptor[0][0:2] == "j(":
+            name = "jmp"
+        else:
+            for name in descriptor[0].split("|"):
+                if not any(name in other[0].split("|") and kinds(other[1]) == kinds(descriptor[1]) for other in db[:k]): break
+        form = Form(descriptor, name)
+        variants = [0, 1, 2, 3] if "mvm" in descriptor[3] else [0, 1] if any(flag[0:2] in ["aS", "aD"] for flag in descriptor[3]) else [0]
+        for v in variants:
+            table[(descriptor[2] >> 8) + v] += (form,)
+    return table
+
+table = buildTable()
+
+# Yields the disassembly of a PROGDAT section one line at a time, with symbols
+# defined in the section as labels and relocated immediates as their symbol's name.
+def disassemble(file, shndx):
+    hdr, section = file.getSection(shndx)
+    SYMTAB_HDR, SYMTAB = file.getSection(file.header.h_symtabndx)
+    _, SYMSTRTAB = file.getSection(SYMTAB_HDR.sh_link)
+    labels, relocs = {}, {}
+    for symbol in SYMTAB.symbols:
+        if symbol.s_shndx == shndx: labels.setdefault(symbol.s_value - hdr.sh_addr, []).append(SYMSTRTAB.getStringByID(symbol.s_name))
+    for i in range(file.header.h_shnum):
+        rel_hdr, reltab = file.getSection(i)
+        if rel_hdr.sh_type != SectionHeader.SHTYPE_RELTAB or rel_hdr.sh_link != shndx: continue
+        for reloc in reltab.relocs:
+            relocs[reloc.r_offset] = SYMSTRTAB.getStringByID(SYMTAB.symbols[reloc.r_symndx].s_name)
+
+    words = section.words
+    i, end = 0, len(words)
+    while i < end:
+        if i in labels:
+            for label in labels[i]: yield label + ":"
+        w = words[i]
+        for form in table[w >> 8]:
+            if w & form.mask == form.bits: break
+        else:
+            form = None
+        if form is None or i + form.size > end: # Data or a truncated instruction
+            yield "\t{:08X}:  {:<24}  .dec {}".format(hdr.sh_addr + i, "{:04X}".format(w), reprImm(w - 0x10000 if w & 0x8000 else w))
+            i += 1
+            continue
+        yield "\t{:08X}:  {:<24}  {}".format(hdr.sh_addr + i, " ".join("{:04X}".format(words[j]) for j in range(i, i + form.size)), form.decode(words, i, relocs))
+        i += form.size
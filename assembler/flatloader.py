@@ -5,10 +5,14 @@ from SLBFManager import *
 verbose = False
 
 def load(in_filepath):
-    if verbose: print("$ - Begin Flat Loader")
     with open(in_filepath, "rb") as f:
         in_file = SLBFManager.deserializeBytes(f.read())
         f.close()
+    return load_file(in_file)
+
+# Returns the memory image lines of an executable already in memory
+def load_file(in_file):
+    if verbose: print("$ - Begin Flat Loader")
     
     if in_file.header.h_type != 2: # If this is not an executable
         raise Exception("Sepecified input file is not an executable file.")
@@ -1,7 +1,183 @@
-import re
+import os, re, marshal
 import traceback
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, islice, chain
+
+class Operand:
+    __slots__ = ("rtype", "itype", "ismem", "rval", "ival")
+    RTYPE_NONE  = 0
+    RTYPE_R16   = 1
+    RTYPE_R32   = 2
+    ITYPE_NONE  = 0
+    ITYPE_ABS   = 1
+    ITYPE_LBL   = 2
+    ITYPE_MEXPR = 3
+    ITYPE_STR   = 4 # File path of .incbin, kept as a string
+    ITYPE_DATA  = 5 # Consecutive constant operands of a data directive, as a list of values
+    
+    def __init__(self, rtype=RTYPE_NONE, itype=ITYPE_NONE, ismem=False, rval=None, ival=None):
+        self.rtype = rtype
+        self.itype = itype
+        self.ismem = ismem
+        self.rval = rval
+        self.ival = ival
+
+def wrap32bits(num):
+    num %= 0xFFFFFFFF
+    if num >= 0x80000000: return 0x100000000 - num
+    else: return num
+
+def mathop(op, args):
+    if op in "~":
+        if len(args) != 1: raise Exception("Operator "+op+" expected 1 argument, got "+str(len(args)))
+        op1 = args[0]
+        if op == "~": val = -op1-1
+        return wrap32bits(val)
+    elif op in "+-*/%&|^<>":
+        if len(args) != 2: raise Exception("Operator "+op+" expected 2 arguments, got "+str(len(args)))
+        op1, op2 = args
+        if op == "+": val = op1 + op2
+        elif op == "-": val = op1 - op2
+        elif op == "*": val = op1 * op2
+        elif op == "/": val = op1 // op2
+        elif op == "%": val = op1 % op2
+        elif op == "&": val = op1 & op2
+        elif op == "|": val = op1 | op2
+        elif op == "^": val = op1 ^ op2
+        elif op == "<": val = 0xFFFFFFFF if wrap32bits(op1) < wrap32bits(op2) else 0
+        elif op == ">": val = 0xFFFFFFFF if wrap32bits(op1) > wrap32bits(op2) else 0
+        return wrap32bits(val)
+    elif op in ["<<", ">>", "==", "~=", "<=", ">="]:
+        if len(args) != 2: raise Exception("Operator "+op+" expected 2 arguments, got "+str(len(args)))
+        op1, op2 = args
+        if op == "<<": val = op1 << op2
+        elif op == ">>": val = op1 >> op2
+        elif op == "==": val = 0xFFFFFFFF if wrap32bits(op1) == wrap32bits(op2) else 0
+        elif op == "~=": val = 0xFFFFFFFF if wrap32bits(op1) != wrap32bits(op2) else 0
+        elif op == "<=": val = 0xFFFFFFFF if wrap32bits(op1) <= wrap32bits(op2) else 0
+        elif op == ">=": val = 0xFFFFFFFF if wrap32bits(op1) >= wrap32bits(op2) else 0
+        return wrap32bits(val)
+    else:
+        raise Exception("Unknown operator \""+str(op)+"\".")
+
+class MathExpr:
+    # A {...} expression compiled to postfix code.
+    # Code items are ints (constants), strs (symbol names) or (op, argc) tuples.
+    __slots__ = ("text", "code")
+    
+    def __init__(self, text, code):
+        self.text = text
+        self.code = code
+    
+    def getSymbol(self):
+        if len(self.code) == 1 and type(self.code[0]) is str: return self.code[0]
+        return None
+    
+    def bind(self, resolve):
+        # resolve(name) returns a symbol's value, or None if it is not known yet.
+        # Returns an int once everything resolves, else the expression with the known parts folded.
+        code = MathExpr.fold(self.code, resolve, True)
+        if type(code) is int: return code
+        return MathExpr(self.text, code)
+    
+    @staticmethod
+    def fold(code, resolve, strict):
+        stack = []
+        for item in code:
+            t = type(item)
+            if t is int:
+                stack.append(item)
+            elif t is str:
+                val = resolve(item)
+                stack.append([item] if val is None else val)
+            else:
+                op, argc = item
+                base = len(stack) - argc
+                args = stack[base:]
+                del stack[base:]
+                for arg in args:
+                    if type(arg) is not int: break
+                else:
+                    if strict:
+                        stack.append(mathop(op, args))
+                        continue
+                    try:
+                        stack.append(mathop(op, args))
+                        continue
+                    except Exception:
+                        pass # Left for evaluation to report
+                frag = []
+                for arg in args:
+                    if type(arg) is int: frag.append(arg)
+                    else: frag.extend(arg)
+                frag.append(item)
+                stack.append(frag)
+        return stack[0]
+
+class Line:
+    __slots__ = ("ln", "label", "cmd", "ops")
+    
+    def __init__(self, ln, label, cmd, ops):
+        self.ln = ln
+        self.label = label
+        self.cmd = cmd
+        self.ops = ops
+
+# Raised when a line can't be lexed. The message may be followed by a traceback.
+class LexError(Exception):
+    def __init__(self, message, ln):
+        super().__init__(str(ln)+": "+message)
+        self.message = message
+        self.ln = ln
+
+# Precompiled grammar for the single-pass tokenizer (Lexer.lexlinefast).
+# The head matches the label and mnemonic fields, then each operand is matched
+# in turn from where the previous one stopped, separator included.
+_LINEHEAD = re.compile(r"(?:(?P<label>[a-z_.@][\w.@]*):)?(?:\s+(?P<cmd>\.?[a-z]\w*))?\s*", re.ASCII | re.IGNORECASE)
+_OPERAND = re.compile(r"""
+    (?:
+        (?P<str>"(?:[^"]|(?<=\\)")*(?<!\\)"|'(?:[^']|(?<=\\)')*(?<!\\)')
+      | (?P<mem>\$\()?
+        (?:%(?P<reg>(?-i:[ABCDEGMLXYSPUVFZ]{1,2}))(?P<plus>\s*\+\s*)?)?
+        (?:
+            (?P<mexpr>\{[^{}"',;]*\})
+          | (?P<lbl>[a-z_.@][\w.@]*)
+          | (?P<bin>[01]+)b
+          | (?P<oct>[0-7]+)o
+          | (?P<dec>[0-9]+)d?
+          | (?P<hex>[0-9][0-9a-f]*)h
+        )?
+        (?(mem)(?(reg)\s*)\))
+    )
+    \s*(?:,\s*|(?=;)|\Z)
+""", re.ASCII | re.IGNORECASE | re.VERBOSE)
+
+def _regtable():
+    regid = "ABCDEGMLXYSPUVFZ"
+    regs = {}
+    for i in range(len(regid)):
+        regs[regid[i]] = (i, Operand.RTYPE_R16)
+        regs[regid[i ^ 0b0001] + regid[i]] = (i, Operand.RTYPE_R32)
+    return regs
+
+_REGS = _regtable()
+
+# Constant operands of data directives are gathered in lists instead of an Operand each
+_DATACMDS = {".dec", ".deca", ".string"}
+_DECIMALS = re.compile(r"\s*([0-9]+(?:\s*,\s*[0-9]+)*)\s*(?:;|\Z)", re.ASCII)
+
+_PATH = re.compile(r"""\s*("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')\s*""")
+
+# Conditional assembly directives, matched on their own so that skipped lines are never lexed
+_CONDITIONAL = re.compile(r"\s+\.(ifdef|ifndef|if|elif|else|endif)\b([^;]*)", re.ASCII | re.IGNORECASE)
+_TAKING, _WAITING, _TAKEN, _DEAD = range(4) # .if block states: assembling, waiting for a true branch, done, never
+
+_MATHLEAF = re.compile(r"(?P<lbl>[a-z_.@][\w.@]*)|(?P<bin>[01]+)b\b|(?P<oct>[0-7]+)o\b|(?P<dec>[0-9]+)d?\b|(?P<hex>[0-9][0-9a-f]*)h\b", re.IGNORECASE)
 
 class Lexer:    
+    PARALLEL_MINSIZE = 1 << 20 # Files smaller than this (in bytes) are always lexed serially
+    PARALLEL_CHUNK = 4096 # Lines per worker task
+    
     @staticmethod
     def __lexlabel(text):
         symbol, chread = Lexer.lexsymbol(text)
@@ -53,6 +229,17 @@ class Lexer:
             ops.extend(Lexer.lexliterals(opraw.strip()))
         return ops, i
     
+    @staticmethod
+    def __lexincbin(text):
+        m = _PATH.match(text)
+        if not m: raise Exception(".incbin 1st argument must be a file path string.")
+        ops = [Operand(itype=Operand.ITYPE_STR, ival=re.sub(r"\\(.)", r"\1", m.group(1)[1:-1]))]
+        i = m.end()
+        if text[i:i+1] != ",": return ops, i
+        bounds, chread = Lexer.__lexoperands(text[i+1:])
+        if not bounds: raise Exception("Expected operand, got nothing.")
+        return ops + bounds, i+1+chread
+    
     @staticmethod
     def isComment(text):
         if re.match(r"\s*(;.*)?$", text): return True
@@ -68,57 +255,57 @@ class Lexer:
     @staticmethod
     def leximm(text):
         mexpr, chread = Lexer.lexmath(text)
-        if chread: return mexpr, "mexpr", chread
+        if chread: return mexpr, Operand.ITYPE_MEXPR, chread
 
         lbl, chread = Lexer.lexsymbol(text)
-        if chread: return lbl, "lbl", chread
+        if chread: return lbl, Operand.ITYPE_LBL, chread
 
         m = re.match(r"([01]+)b\b|([0-7]+)o\b|([0-9]+)d?\b|([0-9][0-9a-f]*)h\b", str.lower(text))
         if m:
-            if m.group(1): return int(m.group(1), 2), "abs", len(m.group(0))
-            if m.group(2): return int(m.group(2), 8), "abs", len(m.group(0))
-            if m.group(3): return int(m.group(3), 10), "abs", len(m.group(0))
-            if m.group(4): return int(m.group(4), 16), "abs", len(m.group(0))
-        return None, "NAN", 0
+            if m.group(1): return int(m.group(1), 2), Operand.ITYPE_ABS, len(m.group(0))
+            if m.group(2): return int(m.group(2), 8), Operand.ITYPE_ABS, len(m.group(0))
+            if m.group(3): return int(m.group(3), 10), Operand.ITYPE_ABS, len(m.group(0))
+            if m.group(4): return int(m.group(4), 16), Operand.ITYPE_ABS, len(m.group(0))
+        return None, Operand.ITYPE_NONE, 0
     
     @staticmethod
     def lexreg(text):
         regid = "ABCDEGMLXYSPUVFZ"
         m = re.match(r"%(["+regid+"]{1,2})", text)
         if m:
-            if len(m.group(1)) == 1: return regid.find(m.group(1)), "r16", len(m.group(0))
+            if len(m.group(1)) == 1: return regid.find(m.group(1)), Operand.RTYPE_R16, len(m.group(0))
             base = regid.find(m.group(1)[1])
             adj = regid.find(m.group(1)[0])
-            if adj != (base ^ 0b0001): return None, "NAR", 0
-            return base, "r32", len(m.group(0))
-        return None, "NAR", 0
+            if adj != (base ^ 0b0001): return None, Operand.RTYPE_NONE, 0
+            return base, Operand.RTYPE_R32, len(m.group(0))
+        return None, Operand.RTYPE_NONE, 0
     
     @staticmethod
     def lexliteral(text):
         if text[0:2] == "$(" and text[-1] == ")":
             text = text[2:-1]
             op = Lexer.lexliteral(text)
-            op["ismem"] = True
+            op.ismem = True
         else:
-            op = {"rtype":None, "itype":None, "ismem":False, "rval":None, "ival":None}
+            op = Operand()
             reg, rtype, chread = Lexer.lexreg(text)
             text = text[chread:].strip()
             if chread:
-                op["rtype"] = rtype
-                op["rval"] = reg
+                op.rtype = rtype
+                op.rval = reg
                 if len(text) > 1 and text[0] == "+": # Expect imm
                     text = text[1:].strip()
                     imm, itype, chread = Lexer.leximm(text)
                     text = text[chread:]
                     if not chread: raise Exception("Expected immediate value after register value.")
-                    op["itype"] = itype
-                    op["ival"] = imm
+                    op.itype = itype
+                    op.ival = imm
             else: # Expect imm
                 imm, itype, chread = Lexer.leximm(text)
                 text = text[chread:]
                 if not chread: raise Exception("Expected operand, got nothing.")
-                op["itype"] = itype
-                op["ival"] = imm
+                op.itype = itype
+                op.ival = imm
             if len(text) != 0: raise Exception("Unknown element \""+text+"\" in operand.")
         return op
     
@@ -176,28 +363,49 @@ class Lexer:
             ops.append(Lexer.lexliteral(text2))
         return ops
     
-    def lexmath(text):
+    @staticmethod
+    def lexmath(text, fold=True):
         if text[0] != "{" or text[-1] != "}": return None, 0
         text = text[1:-1]
-        nodes = []
-        outstack = []
+        postfix = [] # Compiled as it is emitted; ops are (op, argc) tuples
         opstack = []
+        depth = 0
         i = 0
+        
+        def emitop(op):
+            nonlocal depth
+            if op == "~":
+                if depth == 0: raise Exception("Couldn't parse mexpr.")
+                argc = 1
+            else:
+                argc = min(2, depth)
+            postfix.append((op, argc))
+            depth += 1 - argc
 
         while i < len(text):
             if not text[i].isspace():
-                imm, itype, chread = Lexer.leximm(text[i:])
-                if chread:
-                    i+=chread-1
-                    outstack.insert(0, {"type":itype,"val":imm})
+                m = _MATHLEAF.match(text, i)
+                if text[i] == "{" and text[-1] == "}":
+                    mexpr, chread = Lexer.lexmath(text[i:], fold)
+                    i += chread-1
+                    postfix.extend(mexpr.code)
+                    depth += 1
+                elif m:
+                    i += len(m.group(0))-1
+                    if m.group("lbl"): postfix.append(m.group("lbl").lower())
+                    elif m.group("bin"): postfix.append(int(m.group("bin"), 2))
+                    elif m.group("oct"): postfix.append(int(m.group("oct"), 8))
+                    elif m.group("dec"): postfix.append(int(m.group("dec"), 10))
+                    else: postfix.append(int(m.group("hex"), 16))
+                    depth += 1
                 elif text[i]=="(":
-                    opstack.insert(0, "lpar")
+                    opstack.append("lpar")
                 elif text[i]==")":
                     while True:
                         if len(opstack) == 0: raise Exception("Mismatched parentheses in mexpr")
-                        op = opstack.pop(0)
+                        op = opstack.pop()
                         if op == "lpar": break
-                        outstack.insert(0, {"type":"op", "val":op["op"]})
+                        emitop(op[0])
                 else:
                     op = text[i]
                     op2 = text[i:i+2]
@@ -229,57 +437,41 @@ class Lexer:
                     elif op == "&": precedence = 7
                     elif op == "^": precedence = 8
                     elif op == "|": precedence = 9
-                    op = {"op":op, "prec":precedence}
-                    while True:
-                        if len(opstack) == 0: break
-                        o2 = opstack.pop(0)
-                        if o2 == "lpar":
-                            opstack.insert(0, o2)
-                            break
-                        if o2["prec"] <= precedence: outstack.insert(0, {"type":"op", "val":o2["op"]})
-                        else:
-                            opstack.insert(0, o2)
-                            break
-                    opstack.insert(0, op)
+                    while len(opstack) > 0:
+                        o2 = opstack[-1]
+                        if o2 == "lpar" or o2[1] > precedence: break
+                        emitop(opstack.pop()[0])
+                    opstack.append((op, precedence))
             i+=1
         while len(opstack) > 0:
-            op = opstack.pop(0)
+            op = opstack.pop()
             if op == "lpar": raise Exception("Mismatched parentheseses in mexpr")
-            outstack.insert(0, {"type":"op", "val":op["op"]})
-        for v in outstack[::-1]:
-            if v["type"] == "op":
-                newnode = {"type":"op", "op":v["val"]}
-                if v["val"] == "~":
-                    newnode["nodes"] = nodes[-1:]
-                    nodes[-1] = newnode
-                else:
-                    newnode["nodes"] = nodes[-2:]
-                    nodes = nodes[:-2]
-                    nodes.append(newnode)
-            else:
-                nodes.append(v)
-        if len(nodes) > 1: raise Exception("Couldn't parse mexpr.")
-        return nodes[0], i+2
+            emitop(op[0])
+        if depth != 1: raise Exception("Couldn't parse mexpr.")
+        if not fold: return MathExpr(text, postfix), i+2
+        code = MathExpr.fold(postfix, lambda name: None, False) # Constant subtrees are folded now
+        if type(code) is int: code = [code]
+        return MathExpr(text, code), i+2
     
     @staticmethod
     def lexline(text, ln=-1):
         if Lexer.isComment(text):
             return False, None
         
-        data = {}
-        data["ln"] = ln
+        data = Line(ln, "", "", [])
         
         try:
             label, chread = Lexer.__lexlabel(text)
-            data["label"] = label
+            data.label = label
             text = text[chread:]
             
             cmd, chread = Lexer.__lexcmd(text)
-            data["cmd"] = cmd
+            data.cmd = cmd
             text = text[chread:]
             
-            ops, chread = Lexer.__lexoperands(text)
-            data["ops"] = ops
+            if cmd == ".incbin": ops, chread = Lexer.__lexincbin(text)
+            else: ops, chread = Lexer.__lexoperands(text)
+            data.ops = ops
             text = text[chread:]
             
             if ops and not cmd:
@@ -292,21 +484,191 @@ class Lexer:
         return True, data
     
     @staticmethod
-    def lextext(text):
-        lines = []
-        ln = 1
-        for line in text.splitlines():
-            success, linedata = Lexer.lexline(line, ln)
+    def lexlinefast(text, ln=-1):
+        # Single scan over the line with the precompiled grammar above.
+        # Anything it does not recognize (including every error) is handed to
+        # the legacy lexline so results and messages stay identical.
+        head = _LINEHEAD.match(text)
+        label, cmd = head.group("label", "cmd")
+        values = None # Constants of a data directive not added to ops yet
+        if cmd:
+            cmd = cmd.lower()
+            if cmd == ".incbin": return Lexer.lexline(text, ln)
+            if cmd in _DATACMDS:
+                m = _DECIMALS.match(text, head.end())
+                if m: return True, Line(ln, label.lower() if label else "", cmd, [Operand(itype=Operand.ITYPE_DATA, ival=list(map(int, m.group(1).split(","))))])
+                values = []
+        ops = []
+        i = head.end()
+        n = len(text)
+        try:
+            while i < n and text[i] != ";":
+                m = _OPERAND.match(text, i)
+                if not m: return Lexer.lexline(text, ln)
+                i = m.end()
+                string, mem, reg, plus, mexpr, lbl, bin, oct, dec, hex = m.groups()
+                if string:
+                    raw = bytes(string[1:-1], "ascii").decode("unicode_escape")
+                    if not raw.isascii(): return Lexer.lexline(text, ln)
+                    if string[0] == "\"":
+                        chars = list(map(ord, raw))
+                    else:
+                        chars = [(ord(raw[j]) << 8) | ord(raw[j+1]) for j in range(0, len(raw)-1, 2)]
+                        if len(raw) % 2: chars.append(ord(raw[-1]))
+                    if values is not None: values.extend(chars)
+                    else: ops.extend(Operand(itype=Operand.ITYPE_ABS, ival=c) for c in chars)
+                    continue
+                if lbl: itype, ival = Operand.ITYPE_LBL, lbl.lower()
+                elif dec: itype, ival = Operand.ITYPE_ABS, int(dec, 10)
+                elif hex: itype, ival = Operand.ITYPE_ABS, int(hex, 16)
+                elif mexpr: itype, ival = Operand.ITYPE_MEXPR, Lexer.lexmath(mexpr)[0]
+                elif bin: itype, ival = Operand.ITYPE_ABS, int(bin, 2)
+                elif oct: itype, ival = Operand.ITYPE_ABS, int(oct, 8)
+                else: itype, ival = Operand.ITYPE_NONE, None
+                if reg:
+                    if reg not in _REGS: return Lexer.lexline(text, ln)
+                    if (not itype) != (plus is None): return Lexer.lexline(text, ln)
+                    rval, rtype = _REGS[reg]
+                else:
+                    if not itype: return Lexer.lexline(text, ln)
+                    if values is not None and itype == Operand.ITYPE_ABS and not mem:
+                        values.append(ival)
+                        continue
+                    rval, rtype = None, Operand.RTYPE_NONE
+                if values:
+                    ops.append(Operand(itype=Operand.ITYPE_DATA, ival=values))
+                    values = []
+                ops.append(Operand(rtype, itype, mem is not None, rval, ival))
+        except Exception:
+            return Lexer.lexline(text, ln)
+        if values: ops.append(Operand(itype=Operand.ITYPE_DATA, ival=values))
+        if ops and not cmd: return Lexer.lexline(text, ln)
+        if not (label or cmd) and i == head.end(): return False, None
+        return True, Line(ln, label.lower() if label else "", cmd or "", ops)
+
+    @staticmethod
+    def iterlines(lines, fast=True, ln=1):
+        return Lexer.iternumbered(enumerate(lines, ln), fast)
+    
+    # Lexes (line number, text) pairs, like the output of the preprocessor.
+    # If condition is given, .if/.ifdef/.ifndef/.elif/.else/.endif blocks are assembled
+    # conditionally: condition(directive, text, ln) is called for each condition to test,
+    # once every line before it has been used, and lines in the blocks that are not
+    # assembled are only matched against the conditional directives, never lexed.
+    @staticmethod
+    def iternumbered(numbered, fast=True, condition=None):
+        lexline = Lexer.lexlinefast if fast else Lexer.lexline
+        blocks = [] # Open .if blocks as [line, state, after .else]
+        active = True
+        for ln, line in numbered:
+            if condition:
+                m = _CONDITIONAL.match(line)
+                if m:
+                    directive = m.group(1).lower()
+                    active = Lexer.__conditional(blocks, directive, m.group(2).strip(), ln, condition)
+                    continue
+                if not active: continue
+            success, linedata = lexline(line, ln)
             if success:
-                lines.append(linedata)
+                yield linedata
             else:
                 if linedata:
-                    raise Exception(str(ln)+": "+str(linedata))
-            ln += 1
-
-        return lines
+                    raise LexError(str(linedata), ln)
+        if blocks: raise LexError(".if is missing its .endif.", blocks[-1][0])
     
+    # Updates the open blocks for a conditional directive and returns whether the lines
+    # after it are assembled. A block is DEAD inside a block that is not assembled.
     @staticmethod
-    def lexfile(filename):
+    def __conditional(blocks, directive, text, ln, condition):
+        def test():
+            try:
+                return condition(directive, text, ln)
+            except Exception as e:
+                raise LexError(str(e), ln) from e
+        if directive in ["if", "ifdef", "ifndef"]:
+            if blocks and blocks[-1][1] != _TAKING: blocks.append([ln, _DEAD, False])
+            else: blocks.append([ln, _TAKING if test() else _WAITING, False])
+        else:
+            if not blocks: raise LexError("."+directive+" without .if.", ln)
+            block = blocks[-1]
+            if directive == "endif":
+                if text: raise LexError(".endif expected 0 arguments.", ln)
+                blocks.pop()
+            elif block[2]: raise LexError("."+directive+" after .else.", ln)
+            elif directive == "else":
+                if text: raise LexError(".else expected 0 arguments.", ln)
+                block[2] = True
+                if block[1] == _WAITING: block[1] = _TAKING
+                elif block[1] == _TAKING: block[1] = _TAKEN
+            elif block[1] == _WAITING:
+                if test(): block[1] = _TAKING
+            elif block[1] == _TAKING: block[1] = _TAKEN
+        return not blocks or blocks[-1][1] == _TAKING
+    
+    @staticmethod
+    def lextext(text, fast=True):
+        return list(Lexer.iterlines(text.splitlines(), fast))
+    
+    @staticmethod
+    def iterfile(filename, fast=True, jobs=1):
+        if jobs > 1 and os.path.getsize(filename) >= Lexer.PARALLEL_MINSIZE:
+            yield from Lexer.iterfileparallel(filename, fast, jobs)
+            return
+        def splitfile(f):
+            for line in f: yield from line.splitlines()
+        with open(filename, "r") as f:
+            yield from Lexer.iterlines(splitfile(f), fast)
+    
+    @staticmethod
+    def iterfileparallel(filename, fast=True, jobs=2):
+        # Chunks are lexed in worker processes and merged back in order,
+        # so lines and errors (with their original line numbers) come out
+        # exactly as they would from the serial path.
         with open(filename, "r") as f:
-            return Lexer.lextext(f.read())
\ No newline at end of file
+            lines = f.read().splitlines()
+        yield from Lexer.iterparallel(list(enumerate(lines, 1)), fast, jobs)
+    
+    # Lines are read in chunks as they are lexed, with at most two chunks per worker
+    # pending. Conditions can only be tested once the lines before them are assembled, so
+    # from the first chunk with a conditional directive on, lines are lexed serially,
+    # skipping the blocks that are not assembled.
+    @staticmethod
+    def iterparallel(numbered, fast=True, jobs=2, condition=None):
+        numbered = iter(numbered)
+        rest = None
+        with ProcessPoolExecutor(jobs) as pool:
+            pending = []
+            while True:
+                chunk = list(islice(numbered, Lexer.PARALLEL_CHUNK))
+                if not chunk: break
+                if condition and any(_CONDITIONAL.match(line) for _, line in chunk):
+                    rest = chain(chunk, numbered)
+                    break
+                pending.append(pool.submit(_lexchunk, chunk, fast))
+                if len(pending) > 2*jobs: yield from _unpacklines(pending.pop(0).result())
+            for future in pending: yield from _unpacklines(future.result())
+        if rest is not None: yield from Lexer.iternumbered(rest, fast, condition)
+    
+    @staticmethod
+    def lexfile(filename, fast=True):
+        return list(Lexer.iterfile(filename, fast))
+
+def _lexchunk(numbered, fast):
+    # Runs in a worker process. Returns the lexed lines as marshalled tuples,
+    # which cross the process boundary much faster than pickled objects, along
+    # with the lex error (if any) that ended the chunk.
+    packed = []
+    try:
+        for line in Lexer.iternumbered(numbered, fast):
+            packed.append((line.ln, line.label, line.cmd, [(op.rtype, op.itype, op.ismem, op.rval,
+                (op.ival.text, op.ival.code) if op.itype == Operand.ITYPE_MEXPR else op.ival) for op in line.ops]))
+    except LexError as e:
+        return marshal.dumps((packed, (e.message, e.ln)))
+    return marshal.dumps((packed, None))
+
+def _unpacklines(data):
+    packed, error = marshal.loads(data)
+    for ln, label, cmd, ops in packed:
+        yield Line(ln, label, cmd, [Operand(rtype, itype, ismem, rval,
+            MathExpr(*ival) if itype == Operand.ITYPE_MEXPR else ival) for rtype, itype, ismem, rval, ival in ops])
+    if error: raise LexError(*error)
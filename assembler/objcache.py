@@ -0,0 +1,172 @@
+import os, sys, json, time, getopt, hashlib
+
+# Sources whose contents change what the assembler outputs
+TOOLCHAIN = ["asm.py", "lexer.py", "opdb.py", "preprocessor.py", "SLBFManager.py"]
+
+_version = None
+def toolchainVersion():
+    global _version
+    if _version is None:
+        h = hashlib.sha256()
+        for name in TOOLCHAIN:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), "rb") as f:
+                h.update(f.read())
+        _version = h.hexdigest()
+    return _version
+
+# Content-addressed store of assembled objects. Objects are keyed by a hash of the
+# source, the toolchain and the options, and evicted least recently used first once
+# the store grows over maxsize bytes. Every write is atomic so the directory can be
+# shared between processes and machines.
+class ObjectCache:
+    def __init__(self, directory, maxsize=512 << 20):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, options):
+        h = hashlib.sha256()
+        h.update(toolchainVersion().encode())
+        h.update(repr(options).encode())
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[0:2], key[2:] + ".o")
+
+    # Returns the object stored under key, or None if there is none
+    def read(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # Most recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + "." + str(os.getpid()) + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+    # Copies the object stored under key to out_filepath. Returns whether it was found.
+    def get(self, key, out_filepath):
+        data = self.read(key)
+        if data is None: return False
+        with open(out_filepath, "wb") as f:
+            f.write(data)
+        return True
+
+    def put(self, key, in_filepath):
+        with open(in_filepath, "rb") as f:
+            self.write(key, f.read())
+
+    # Removes the least recently used objects until the cache fits in maxsize
+    def evict(self):
+        entries, total = [], 0
+        for path, st in self.objects():
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        removed = 0
+        for mtime, size, path in entries:
+            if total <= self.maxsize: break
+            try: os.remove(path)
+            except FileNotFoundError: pass
+            total -= size
+            removed += 1
+        return removed
+
+    def objects(self):
+        if not os.path.isdir(self.directory): return
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir(): continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".o"): yield entry.path, entry.stat()
+
+    def loadStats(self):
+        try:
+            with open(os.path.join(self.directory, "stats"), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"hits": 0, "misses": 0, "since": time.time()}
+
+    # Adds the hits and misses counted by this process to the stored totals
+    def saveStats(self, hits=None, misses=None, reset=False):
+        stats = {"hits": 0, "misses": 0, "since": time.time()} if reset else self.loadStats()
+        stats["hits"] += self.hits if hits is None else hits
+        stats["misses"] += self.misses if misses is None else misses
+        os.makedirs(self.directory, exist_ok=True)
+        temp = os.path.join(self.directory, "stats." + str(os.getpid()) + ".tmp")
+        with open(temp, "w") as f:
+            json.dump(stats, f)
+        os.replace(temp, os.path.join(self.directory, "stats"))
+        return stats
+
+    def reprStats(self):
+        stats = self.loadStats()
+        count, size = 0, 0
+        for path, st in self.objects():
+            count += 1
+            size += st.st_size
+        lookups = stats["hits"] + stats["misses"]
+        lines = ["[CACHE] "+self.directory]
+        lines.append("\tHITS:\t\t"+str(stats["hits"])+(" ({:.1f}%)".format(100*stats["hits"]/lookups) if lookups else ""))
+        lines.append("\tMISSES:\t\t"+str(stats["misses"]))
+        lines.append("\tOBJECTS:\t"+str(count))
+        lines.append("\tSIZE:\t\t{} KiB / {} KiB".format(size >> 10, self.maxsize >> 10))
+        lines.append("\tSINCE:\t\t"+time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stats["since"])))
+        return "\n".join(lines)
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "hzC", ["help", "max-size="])
+    maxsize = 512 << 20
+    zero, clear, resize = False, False, False
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Displays and manages an asm.py object cache.")
+            print("Usage: py objcache.py [options] directory")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-z: Reset the hit and miss statistics.")
+            print("\t-C: Remove every cached object.")
+            print("\t--max-size=MIB: Evict least recently used objects until the cache fits in MIB MiB.\n")
+            print("\tdirectory is the cache directory given to asm.py --cache.\n")
+            exit(0)
+        if o == "-z":
+            zero = True
+        if o == "-C":
+            clear = True
+        if o == "--max-size":
+            if not a.isdigit():
+                print("[FATAL] Invalid cache size \""+a+"\". Expected a number of MiB.")
+                exit(-1)
+            maxsize = int(a) << 20
+            resize = True
+    if len(args) != 1:
+        print("[FATAL] Expected exactly one cache directory.")
+        exit(-1)
+    if not os.path.isdir(args[0]):
+        print("[FATAL] \""+args[0]+"\" is not a directory.")
+        exit(-1)
+
+    cache = ObjectCache(args[0], maxsize)
+    if clear:
+        cache.maxsize = 0
+        print("$ - Removed "+str(cache.evict())+" objects")
+        cache.maxsize = maxsize
+    elif resize:
+        print("$ - Evicted "+str(cache.evict())+" objects")
+    if zero: cache.saveStats(reset=True)
+    print(cache.reprStats())
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
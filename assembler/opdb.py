@@ -1,4 +1,6 @@
-import re
+import re, itertools
+from array import array
+from lexer import Operand
 
 db = [
     ["rst", [], 0x0000, []],
@@ -126,122 +128,188 @@ condcodes = {
     "nr":       0b1111
 }
 
+# 16-bit address and memory offsets are sign-extended to 32 bits
+def fitsOffset16(value):
+    value &= 0xFFFFFFFF
+    return value < 0x8000 or value >= 0xFFFF8000
+
+def matchOperand(opc, op):
+    # Checks op against an operand class. Memory and address operands given
+    # without a base register are rewritten to use %Z, like the encoder expects.
+    if opc in ["imm", "imm16", "imm32"]:
+        if op.ismem: return False
+        if op.rtype: return False
+        if not op.itype: return False
+        if opc == "imm16":
+            if op.itype != Operand.ITYPE_ABS: return False
+            if not (op.ival & 0xFFFF < 0x10000): return False
+    elif opc in ["reg", "reg16", "reg32"]:
+        if op.ismem: return False
+        if op.itype: return False
+        if not op.rtype: return False
+        if opc == "reg16":
+            if op.rtype != Operand.RTYPE_R16: return False
+        if opc == "reg32":
+            if op.rtype != Operand.RTYPE_R32: return False
+    elif opc == "addr0":
+        if op.ismem: return False
+        if op.itype: return False
+        if not op.rtype: return False
+    elif opc == "addr16":
+        if op.ismem: return False
+        if op.itype != Operand.ITYPE_ABS: return False
+        if not fitsOffset16(op.ival): return False
+        if not op.rtype:
+            op.rtype = Operand.RTYPE_R16
+            op.rval = 0b1111 # %Z+imm16
+    elif opc == "addr32":
+        if op.ismem: return False
+        if not op.itype: return False
+        if not op.rtype:
+            op.rtype = Operand.RTYPE_R16
+            op.rval = 0b1111 # %Z+imm32
+    elif opc == "mem0":
+        if not op.ismem: return False
+        if op.itype: return False
+        if not op.rtype: return False
+    elif opc == "mem16":
+        if not op.ismem: return False
+        if op.itype != Operand.ITYPE_ABS: return False
+        if not fitsOffset16(op.ival): return False
+        if not op.rtype:
+            op.rtype = Operand.RTYPE_R16
+            op.rval = 0b1111 # %Z+imm16
+    elif opc == "mem32":
+        if not op.ismem: return False
+        if not op.itype: return False
+        if not op.rtype:
+            op.rtype = Operand.RTYPE_R16
+            op.rval = 0b1111 # %Z+imm32
+    return True
+
+# Compiles a descriptor's flags into an encoder that appends the words for an operand
+# list to out and records relocation slots (word offset in out, instruction index i
+# and operand number) in three parallel arrays, so no flag is parsed while assembling.
+# Flags that only set constant bits before any operand is used are folded into the opcode.
+def compileForm(descriptor, cc=None):
+    opcode = descriptor[2]
+    src = []
+    words = ["w"]
+    dynamic = False
+    for i, opc in enumerate(descriptor[1]):
+        if opc in ["addr16", "addr32", "mem16", "mem32"]:
+            src.append("if not o"+str(i)+".rtype: o"+str(i)+".rtype, o"+str(i)+".rval = "+str(Operand.RTYPE_R16)+", 0b1111")
+    for flag in descriptor[3]:
+        kind, opN = flag[0:2], flag[2:]
+        if flag == "rcc" or flag == "rsp":
+            mask, bits = (0x00F0, cc << 4) if flag == "rcc" else (0x00FF, 0xBB)
+            if not dynamic: opcode = (opcode & ~mask) | bits
+            else: src.append("w = (w & ~"+hex(mask)+") | "+hex(bits))
+            continue
+        if flag == "mvm":
+            src.append("w = ((w + (0x0200 if o0.rtype == "+str(Operand.RTYPE_R32)+" else 0) + (0x0100 if o1.rtype == "+str(Operand.RTYPE_R32)+" else 0)) & ~0x00FF) | (o0.rval << 4) | o1.rval")
+        elif kind in ["rS", "aS"]:
+            src.append("w = (w & ~0x00F0) | (o"+opN+".rval << 4)")
+        elif kind in ["rD", "aD"]:
+            src.append("w = (w & ~0x000F) | o"+opN+".rval")
+        elif kind == "iw":
+            words.append("o"+opN+".ival & 0xFFFF")
+        elif kind == "id":
+            lo, hi = "d"+str(len(words)), "d"+str(len(words)+1)
+            src.append("if o"+opN+".itype == "+str(Operand.ITYPE_ABS)+": "+lo+", "+hi+" = o"+opN+".ival & 0xFFFF, (o"+opN+".ival >> 16) & 0xFFFF")
+            src.append("else: "+lo+" = "+hi+" = 0; offsets.append(len(out) + "+str(len(words))+"); indices.append(i); opNs.append("+opN+")")
+            words.extend([lo, hi])
+        else:
+            continue # Unknown flags are ignored
+        if kind in ["aS", "aD"]:
+            src.append("if o"+opN+".rtype == "+str(Operand.RTYPE_R32)+": w += 0x0100")
+        dynamic = True
+    head = ["def encode(ops, out, i, offsets, indices, opNs):"]
+    if len(descriptor[1]) != 0: head.append("    "+"".join("o"+str(i)+", " for i in range(len(descriptor[1])))+"= ops")
+    head.append("    w = "+hex(opcode))
+    tail = "    out.append(w)" if len(words) == 1 else "    out.extend(("+", ".join(words)+"))"
+    src = head + ["    "+line for line in src] + [tail]
+    scope = {}
+    exec("\n".join(src), scope)
+    return scope["encode"]
+
+# Offset of operand n's immediate in the words encoded by descriptor
+def immOffset(descriptor, n):
+    offset = 1
+    for flag in descriptor[3]:
+        if flag in ["iw"+str(n), "id"+str(n)]: return offset
+        if flag[0:2] == "iw": offset += 1
+        elif flag[0:2] == "id": offset += 2
+    return None
+
+# Maps (mnemonic, *operand kinds) to the encoder of the first matching form in db.
+# Whether an operand fits a class only depends on its kind, so every class
+# is probed once per kind and the accepted combinations are expanded.
+# Forms that only differ by the width of an address or memory offset are paired:
+# shortforms maps a 32-bit offset encoder to (n, 16-bit encoder, offset of the 16-bit immediate)
+# and longforms maps a 16-bit offset encoder to (n, 32-bit encoder).
+def buildIndex():
+    kinds = list(itertools.product([False, True],
+                                   [Operand.RTYPE_NONE, Operand.RTYPE_R16, Operand.RTYPE_R32],
+                                   [Operand.ITYPE_NONE, Operand.ITYPE_ABS, Operand.ITYPE_LBL, Operand.ITYPE_MEXPR]))
+    index = {}
+    forms = {}
+    for descriptor in db:
+        if "(" in descriptor[0]: # j(cc)
+            prefix = descriptor[0][:descriptor[0].index("(")]
+            names = [(prefix+code, cc) for regex, cc in condcodes.items() for code in regex.split("|")]
+        else:
+            names = [(name, None) for name in descriptor[0].split("|")]
+        accepted = [[(ismem << 4) | (rtype << 2) | itype for ismem, rtype, itype in kinds
+                     if matchOperand(opc, Operand(rtype, itype, ismem, 0, 0))] for opc in descriptor[1]]
+        for name, cc in names:
+            if (id(descriptor), cc) not in forms: forms[(id(descriptor), cc)] = compileForm(descriptor, cc)
+            for opkinds in itertools.product(*accepted):
+                index.setdefault((name,)+opkinds, forms[(id(descriptor), cc)])
+    
+    shortforms, longforms = {}, {}
+    for long in db:
+        for n, opc in enumerate(long[1]):
+            if opc not in ["addr32", "mem32"]: continue
+            classes = long[1][:n] + [opc[:-2]+"16"] + long[1][n+1:]
+            for short in db:
+                if short[0] == long[0] and short[1] == classes: break
+            else:
+                continue
+            for (formid, cc), encode in forms.items():
+                if formid != id(long): continue
+                shortforms[encode] = (n, forms[(id(short), cc)], immOffset(short, n))
+                longforms[forms[(id(short), cc)]] = (n, encode)
+    return index, shortforms, longforms
+
+index, shortforms, longforms = buildIndex()
+
+# Returns the encoder of the form matching cmd and ops, for use with encodeMany
+def findInst(cmd, ops):
+    encode = index.get((cmd, *[(op.ismem << 4) | (op.rtype << 2) | op.itype for op in ops]))
+    if not encode:
+        if re.match("j(\\w{1,2})$", cmd) and ("jmp", *[(op.ismem << 4) | (op.rtype << 2) | op.itype for op in ops]) in index:
+            raise Exception("\""+cmd+"\" is not recognized as a condition code.")
+        raise Exception("Could not find command \""+cmd+"\" in database.")
+    if encode in longforms: # Absolute offsets that don't fit in 16 bits take the 32-bit form
+        n, long = longforms[encode]
+        if not fitsOffset16(ops[n].ival): return long
+    return encode
+
+# Encodes a list of (encoder, ops) pairs from findInst into out, usually an array("H").
+# Relocations are returned as parallel arrays of word offsets in out, indices in insts and operand numbers.
+def encodeMany(insts, out):
+    offsets, indices, opNs = array("L"), array("L"), array("B")
+    i = 0
+    for encode, ops in insts:
+        encode(ops, out, i, offsets, indices, opNs)
+        i += 1
+    return offsets, indices, opNs
+
 # Expects immediate operands to have been converted to default values.
 # itypes should be kept
 # Returns a word-list object and potential relocation offsets
 def matchInst(cmd, ops):
-    for descriptor in db:
-        nameMatch = re.match("("+descriptor[0]+")$", cmd)
-        if not nameMatch: continue
-        if len(descriptor[1]) != len(ops): continue
-        for i in range(len(ops)):
-            opermatches = False
-            opc = descriptor[1][i]
-            if opc in ["imm", "imm16", "imm32"]:
-                if ops[i]["ismem"]: break
-                if ops[i]["rtype"]: break
-                if not ops[i]["itype"]: break
-                if opc == "imm16":
-                    if ops[i]["itype"] != "abs": break
-                    if not (ops[i]["ival"] & 0xFFFF < 0x10000): break
-            elif opc in ["reg", "reg16", "reg32"]:
-                if ops[i]["ismem"]: break
-                if ops[i]["itype"]: break
-                if not ops[i]["rtype"]: break
-                if opc == "reg16":
-                    if ops[i]["rtype"] != "r16": break
-                if opc == "reg32":
-                    if ops[i]["rtype"] != "r32": break
-            elif opc == "addr0":
-                if ops[i]["ismem"]: break
-                if ops[i]["itype"]: break
-                if not ops[i]["rtype"]: break
-            elif opc == "addr16":
-                if ops[i]["ismem"]: break
-                if ops[i]["itype"] != "abs": break
-                if not (ops[i]["ival"] & 0xFFFF < 0x10000): break
-                if not ops[i]["rtype"]:
-                    ops[i]["rtype"] = "r16"
-                    ops[i]["rval"] = 0b1111 # %Z+imm16
-            elif opc == "addr32":
-                if ops[i]["ismem"]: break
-                if not ops[i]["itype"]: break
-                if not ops[i]["rtype"]:
-                    ops[i]["rtype"] = "r16"
-                    ops[i]["rval"] = 0b1111 # %Z+imm32
-            elif opc == "mem0":
-                if not ops[i]["ismem"]: break
-                if ops[i]["itype"]: break
-                if not ops[i]["rtype"]: break
-            elif opc == "mem16":
-                if not ops[i]["ismem"]: break
-                if ops[i]["itype"] != "abs": break
-                if not (ops[i]["ival"] & 0xFFFF < 0x10000): break
-                if not ops[i]["rtype"]:
-                    ops[i]["rtype"] = "r16"
-                    ops[i]["rval"] = 0b1111 # %Z+imm16
-            elif opc == "mem32":
-                if not ops[i]["ismem"]: break
-                if not ops[i]["itype"]: break
-                if not ops[i]["rtype"]:
-                    ops[i]["rtype"] = "r16"
-                    ops[i]["rval"] = 0b1111 # %Z+imm32
-        else:
-            opermatches = True
-        if not opermatches: continue
-        relocs = []
-        ret = [descriptor[2]]        
-        for flag in descriptor[3]:
-            if flag[0:2] == "rS":
-                opN = int(flag[2:])
-                ret[0] &= ~0x00F0
-                ret[0] |= ops[opN]["rval"] << 4
-            elif flag[0:2] == "rD":
-                opN = int(flag[2:])
-                ret[0] &= ~0x000F
-                ret[0] |= ops[opN]["rval"]
-            elif flag[0:2] == "iw":
-                opN = int(flag[2:])
-                ret.append(ops[opN]["ival"] & 0xFFFF)
-            elif flag[0:2] == "id":
-                opN = int(flag[2:])
-                if ops[opN]["itype"] != "abs":
-                    relocs.append({"offset": len(ret), "opN": opN})
-                    ret.extend([0, 0])
-                else:
-                    ret.append(ops[opN]["ival"] & 0xFFFF)
-                    ret.append((ops[opN]["ival"] >> 16) & 0xFFFF)
-            elif flag[0:2] == "aS":
-                opN = int(flag[2:])
-                ret[0] &= ~0x00F0
-                ret[0] |= ops[opN]["rval"] << 4
-                if ops[opN]["rtype"] == "r32": ret[0] += 0x0100
-            elif flag[0:2] == "aD":
-                opN = int(flag[2:])
-                ret[0] &= ~0x000F
-                ret[0] |= ops[opN]["rval"]
-                if ops[opN]["rtype"] == "r32": ret[0] += 0x0100
-            elif flag == "rcc":
-                condcode = nameMatch.group(2)
-                for regex, cc in condcodes.items():
-                    if re.match("("+regex+")$", condcode):
-                        condcode = cc
-                        break
-                else:
-                    raise Exception("\"j"+condcode+"\" is not recognized as a condition code.")
-                ret[0] &= ~0x00F0
-                ret[0] |= cc << 4                
-            elif flag == "rsp":
-                ret[0] &= ~0x00FF
-                ret[0] |= 0xBB # 2x %P
-            elif flag == "mvm":
-                op0 = ops[0]
-                op1 = ops[1]
-                if op0["rtype"] == "r32": ret[0] += 0x0200
-                if op1["rtype"] == "r32": ret[0] += 0x0100
-                ret[0] &= ~0x00FF
-                ret[0] |= op0["rval"] << 4
-                ret[0] |= op1["rval"]
-        
-        return ret, relocs
-    raise Exception("Could not find command \""+cmd+"\" in database.")
\ No newline at end of file
+    ret, offsets, opNs = [], [], []
+    findInst(cmd, ops)(ops, ret, 0, offsets, [], opNs)
+    return ret, [{"offset": offset, "opN": opN} for offset, opN in zip(offsets, opNs)]
@@ -0,0 +1,51 @@
+import os, sys, getopt, time
+from array import array
+
+from lexer import Lexer, Operand
+from opdb import matchInst, findInst, encodeMany
+
+def bench(filepaths, rounds):
+    insts = []
+    for filepath in filepaths:
+        for line in Lexer.lexfile(filepath):
+            if line.cmd and line.cmd[0] != ".": insts.append(line)
+    if len(insts) == 0: raise Exception("No instructions to encode.")
+    # Encoding rewrites some operands, so every round gets fresh copies
+    def copies():
+        return [[(line.cmd, [Operand(op.rtype, op.itype, op.ismem, op.rval, op.ival) for op in line.ops]) for line in insts] for _ in range(rounds)]
+    work = copies()
+    start = time.perf_counter()
+    for batch in work:
+        for cmd, ops in batch: matchInst(cmd, ops)
+    single = time.perf_counter() - start
+    work = [[(findInst(cmd, ops), ops) for cmd, ops in batch] for batch in copies()]
+    start = time.perf_counter()
+    for batch in work:
+        encodeMany(batch, array("H"))
+    bulk = time.perf_counter() - start
+    return len(insts), single / (rounds * len(insts)), bulk / (rounds * len(insts))
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "hn:", ["help"])
+    rounds = 2000
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Measures the per-instruction cost of opdb.matchInst and opdb.encodeMany.")
+            print("Usage: py opdbbench.py [options] files...")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-n ROUNDS: Encode every instruction ROUNDS times (Default 2000).\n")
+            print("\tfile... is a list of assembly files to take instructions from. Defaults to src/sieve.s.\n")
+            exit(0)
+        if o == "-n":
+            rounds = int(a)
+    if len(args) == 0: args = [os.path.join(os.path.dirname(os.path.abspath(__file__)), "src", "sieve.s")]
+
+    count, single, bulk = bench(args, rounds)
+    print("$ - "+str(count)+" instructions x "+str(rounds)+" rounds")
+    print("$ - matchInst: "+format(single*1e6, ".2f")+" us per instruction")
+    print("$ - encodeMany: "+format(bulk*1e6, ".2f")+" us per instruction (lookup excluded)")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,510 @@
+import os, sys, re, pickle, getopt
+
+from objcache import toolchainVersion
+
+class PreprocessError(Exception):
+    def __init__(self, message, filename=None, ln=None):
+        super().__init__(message)
+        self.message = message
+        self.filename = filename
+        self.ln = ln
+
+    def __str__(self):
+        where = ":".join(str(part) for part in [self.filename, self.ln] if part is not None)
+        return (where + ": " if where else "") + self.message
+
+DIRECTIVES = ["include", "define", "xdefine", "undef", "macro", "endmacro", "if", "elif", "else", "endif", "error"]
+MAX_DEPTH = 64 # Deepest nesting of #include files or of macro expansions
+MAX_VARIANTS = 8 # Most precompiled headers kept for one file, for different definitions
+
+_DIRECTIVE = re.compile(r"\s*#\s*([a-z]+)\b\s*(.*)", re.ASCII)
+_NAME = re.compile(r"[A-Za-z_]\w*", re.ASCII)
+_COMMENT = re.compile(r"""("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|<[^>;]*>)|;.*""")
+# Names are looked for outside of strings, comments, registers and numbers
+_TOKEN = re.compile(r"""(?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|;.*|%\w+|\d\w*|(?P<name>[A-Za-z_.@][\w.@]*)""", re.ASCII)
+# Macro bodies also have the # and ## operators, and arguments can follow %
+_BODY = re.compile(r"""(?P<lit>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')|;.*|(?P<paste>[ \t]*\#\#[ \t]*)|\#(?P<str>[A-Za-z_]\w*)|(?P<name>[A-Za-z_.@][\w.@]*)|\d\w*""", re.ASCII)
+_PASTEIN = re.compile(r"##([A-Za-z_]\w*)", re.ASCII)
+_DEFINED = re.compile(r"@([A-Za-z_]\w*)", re.ASCII)
+_CONDTOKEN = re.compile(r"""\s*(?:
+    (?P<str>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<bin>[01]+)b\b | (?P<oct>[0-7]+)o\b | (?P<dec>[0-9]+)d?\b | (?P<hex>[0-9][0-9a-f]*)h\b
+  | (?P<name>[a-z_.@][\w.@]*)
+  | (?P<op><<|>>|==|~=|<=|>=|[-+*/%&|^~<>()])
+)""", re.ASCII | re.IGNORECASE | re.VERBOSE)
+_BINARY = {"*": 2, "/": 2, "%": 2, "+": 3, "-": 3, "<<": 4, ">>": 4, "<": 5, ">": 5, "<=": 5, ">=": 5, "==": 6, "~=": 6, "&": 7, "^": 8, "|": 9}
+
+def stripComment(text):
+    return _COMMENT.sub(lambda m: m.group(1) or "", text).strip()
+
+# Splits source lines into [line number, directive, text, names] items. Directives keep their
+# arguments as text and may continue over several lines with \. The names of other lines
+# are only found once they are needed.
+def iterItems(lines):
+    lines = iter(lines)
+    ln = 0
+    for text in lines:
+        ln += 1
+        m = _DIRECTIVE.match(text) if "#" in text else None
+        if m is None or m.group(1) not in DIRECTIVES:
+            yield [ln, None, text, None]
+            continue
+        start = ln
+        while text.rstrip().endswith("\\"):
+            more = next(lines, None)
+            if more is None: break
+            ln += 1
+            text = text.rstrip()[:-1] + more
+        m = _DIRECTIVE.match(text)
+        yield [start, m.group(1), stripComment(m.group(2)), None]
+
+def fileStamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+_parsed = {} # Included file paths -> (stamp, items), kept for as long as the file is unchanged
+
+def parseFile(path):
+    stamp = fileStamp(path)
+    cached = _parsed.get(path)
+    if cached and cached[0] == stamp: return cached
+    with open(path, "r") as f:
+        cached = stamp, list(iterItems(f.read().splitlines()))
+    _parsed[path] = cached
+    return cached
+
+# Returns the (args, end) of the parenthesized macro arguments starting at i, or (None, i) if there are none
+def parseArgs(text, i):
+    j = i
+    while j < len(text) and text[j] in " \t": j += 1
+    if j >= len(text) or text[j] != "(": return None, i
+    args, depth, quote, start = [], 0, None, j+1
+    k = j+1
+    while k < len(text):
+        c = text[k]
+        if quote:
+            if c == "\\": k += 1
+            elif c == quote: quote = None
+        elif c in "\"'": quote = c
+        elif c == "(": depth += 1
+        elif c == ")":
+            if depth == 0:
+                args.append(text[start:k].strip())
+                if args == [""]: args = []
+                return args, k+1
+            depth -= 1
+        elif c == "," and depth == 0:
+            args.append(text[start:k].strip())
+            start = k+1
+        k += 1
+    raise Exception("Missing ) after macro arguments.")
+
+# Joins the pieces of an instantiated macro line. Stringified arguments are merged into the
+# string literals next to them (whitespace between them is dropped).
+def joinPieces(pieces):
+    out = [] # Text, and lists of adjacent (kind, text) literals
+    for kind, text in pieces:
+        if kind == "text":
+            out.append(text)
+        elif out and type(out[-1]) is list:
+            out[-1].append((kind, text))
+        elif len(out) >= 2 and type(out[-2]) is list and not out[-1].strip():
+            out[-2].append(("text", out.pop()))
+            out[-1].append((kind, text))
+        else:
+            out.append([(kind, text)])
+    result = []
+    for piece in out:
+        if type(piece) is str:
+            result.append(piece)
+        elif all(kind != "str" for kind, _ in piece):
+            result.append("".join(text for _, text in piece))
+        else:
+            lits = [text for kind, text in piece if kind == "lit"]
+            if not lits: raise Exception("A stringified argument must be next to a string.")
+            quote = lits[0][0]
+            result.append(quote + "".join(text[1:-1] if kind == "lit" else text.replace("\\", "\\\\").replace(quote, "\\"+quote)
+                                          for kind, text in piece if kind != "text") + quote)
+    return "".join(result)
+
+def instantiate(params, body, raw, args):
+    values = dict(zip(params, args))
+    rawvalues = dict(zip(params, raw))
+    lines = []
+    for line in body:
+        pieces, pos = [], 0
+        for m in _BODY.finditer(line):
+            pieces.append(("text", line[pos:m.start()]))
+            pos = m.end()
+            if m.lastgroup == "lit": pieces.append(("lit", _PASTEIN.sub(lambda p: rawvalues.get(p.group(1), p.group(0)), m.group())))
+            elif m.lastgroup == "paste": pieces.append(("text", ""))
+            elif m.lastgroup == "str" and m.group("str") in rawvalues: pieces.append(("str", rawvalues[m.group("str")]))
+            elif m.lastgroup == "name": pieces.append(("text", values.get(m.group(), m.group())))
+            else: pieces.append(("text", m.group()))
+        pieces.append(("text", line[pos:]))
+        lines.append(joinPieces(pieces))
+    return "\n".join(lines)
+
+def evalCondition(text):
+    tokens, pos = [], 0
+    while pos < len(text.rstrip()):
+        m = _CONDTOKEN.match(text, pos)
+        if not m: raise Exception("Unknown element \""+text[pos:].strip()+"\" in condition.")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "str": tokens.append(("val", m.group(kind)[1:-1]))
+        elif kind == "bin": tokens.append(("val", int(m.group(kind), 2)))
+        elif kind == "oct": tokens.append(("val", int(m.group(kind), 8)))
+        elif kind == "dec": tokens.append(("val", int(m.group(kind), 10)))
+        elif kind == "hex": tokens.append(("val", int(m.group(kind), 16)))
+        else: tokens.append((kind, m.group(kind)))
+    pos = 0
+
+    def unary():
+        nonlocal pos
+        if pos >= len(tokens): raise Exception("Incomplete condition.")
+        kind, value = tokens[pos]
+        pos += 1
+        if kind == "val": return value
+        if kind == "name": raise Exception("Undefined symbol \""+value+"\" in condition.")
+        if value == "(":
+            result = binary(9)
+            if tokens[pos:pos+1] != [("op", ")")]: raise Exception("Mismatched parentheses in condition.")
+            pos += 1
+            return result
+        if value in ["~", "-"]:
+            operand = unary()
+            if type(operand) is not int: raise Exception("Operator "+value+" expects a number.")
+            return ~operand if value == "~" else -operand
+        raise Exception("Unexpected \""+value+"\" in condition.")
+
+    # Lower levels bind tighter
+    def binary(level):
+        nonlocal pos
+        left = unary()
+        while pos < len(tokens) and tokens[pos][0] == "op" and _BINARY.get(tokens[pos][1], 10) <= level:
+            op = tokens[pos][1]
+            pos += 1
+            right = binary(_BINARY[op] - 1)
+            if op in ["==", "~="]:
+                if type(left) is not type(right): raise Exception("Cannot compare a string with a number.")
+                left = int((left == right) == (op == "=="))
+                continue
+            if type(left) is not int or type(right) is not int: raise Exception("Operator "+op+" expects numbers.")
+            if op in ["/", "%"] and right == 0: raise Exception("Division by zero in condition.")
+            if op == "*": left = left * right
+            elif op == "/": left = left // right
+            elif op == "%": left = left % right
+            elif op == "+": left = left + right
+            elif op == "-": left = left - right
+            elif op == "<<": left = left << right
+            elif op == ">>": left = left >> right
+            elif op == "<": left = int(left < right)
+            elif op == ">": left = int(left > right)
+            elif op == "<=": left = int(left <= right)
+            elif op == ">=": left = int(left >= right)
+            elif op == "&": left = left & right
+            elif op == "^": left = left ^ right
+            elif op == "|": left = left | right
+        return left
+
+    result = binary(9)
+    if pos != len(tokens): raise Exception("Unexpected \""+str(tokens[pos][1])+"\" in condition.")
+    return result not in [0, ""]
+
+# What including a file did: the lines it produced, the definitions it made (the last one
+# of each name) and the definitions it read before making them. Including the file again while those are
+# the same, and while the files it read are unchanged, does exactly the same.
+class Header:
+    __slots__ = ("files", "uses", "effects", "lines")
+
+    def __init__(self):
+        self.files = {} # Path -> stamp of the file and of every file it included
+        self.uses = {}
+        self.effects = {}
+        self.lines = []
+
+# Precompiled headers by path, most recently made first. They are kept in memory for every
+# file preprocessed with the same cache, and loaded from and saved to filepath if one is given.
+class HeaderCache:
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        self.added = False
+        self.headers = self.load() if filepath else {}
+
+    def load(self):
+        try:
+            with open(self.filepath, "rb") as f:
+                data = pickle.load(f)
+            if data["version"] == toolchainVersion(): return data["headers"]
+        except Exception:
+            pass # Missing, unreadable or from another version of the toolchain
+        return {}
+
+    # Headers saved meanwhile by other processes are kept
+    def save(self):
+        headers = self.load()
+        headers.update(self.headers)
+        temp = self.filepath + "." + str(os.getpid()) + ".tmp"
+        with open(temp, "wb") as f:
+            pickle.dump({"version": toolchainVersion(), "headers": headers}, f)
+        os.replace(temp, self.filepath)
+        self.headers = headers
+        self.added = False
+
+    # Returns the headers of path whose files are unchanged
+    def get(self, path):
+        return [header for header in self.headers.get(path, []) if all(fileStamp(filepath) == stamp for filepath, stamp in header.files.items())]
+
+    def put(self, path, header):
+        variants = self.headers.setdefault(path, [])
+        variants.insert(0, header)
+        del variants[MAX_VARIANTS:]
+        self.added = True
+
+# Expands preprocessor directives and macros. Definitions are ("define", value) or
+# ("macro", ((argc, params, body), ...)) tuples. Lines come out as (line, text) pairs, where
+# line is the line number in the file being preprocessed, or a (path, line number) pair for
+# lines from included files.
+class Preprocessor:
+    def __init__(self, includedirs=[], defines={}, headers=None):
+        self.includedirs = list(includedirs)
+        self.defs = {name: ("define", value) for name, value in defines.items()}
+        self.headers = headers
+        self.recorders = [] # (Header, names defined so far) of every #include being read, innermost last
+
+    def iterfile(self, filename):
+        def splitfile(f):
+            for line in f: yield from line.splitlines()
+        with open(filename, "r") as f:
+            yield from self.process(iterItems(splitfile(f)), filename, os.path.dirname(filename), 0)
+
+    def itertext(self, text, filename="<text>", directory=None):
+        if directory is None: directory = os.path.dirname(filename)
+        yield from self.process(iterItems(text.splitlines()), filename, directory, 0)
+
+    def getDef(self, name):
+        definition = self.defs.get(name)
+        for header, written in self.recorders:
+            if name not in written and name not in header.uses: header.uses[name] = definition
+        return definition
+
+    def setDef(self, name, definition):
+        if definition is None: self.defs.pop(name, None)
+        else: self.defs[name] = definition
+        for header, written in self.recorders:
+            written.add(name)
+            header.effects[name] = definition
+
+    def process(self, items, filename, directory, depth):
+        conds = [] # [enclosing block active, branch taken, #else seen, line] of every open #if
+        active = True
+        macro = None # [name, params, body, line] while reading a #macro
+        for item in items:
+            ln, directive, text, _ = item
+            try:
+                if macro is not None:
+                    if directive == "endmacro":
+                        self.defineMacro(*macro[0:3])
+                        macro = None
+                    elif directive:
+                        raise Exception("#"+directive+" is not allowed in a macro body.")
+                    else:
+                        macro[2].append(text)
+                    continue
+                if directive == "if":
+                    conds.append([active, False, False, ln])
+                    active = active and self.condition(text)
+                    conds[-1][1] = active
+                    continue
+                if directive == "elif":
+                    if not conds: raise Exception("#elif without #if.")
+                    if conds[-1][2]: raise Exception("#elif after #else.")
+                    active = conds[-1][0] and not conds[-1][1] and self.condition(text)
+                    conds[-1][1] |= active
+                    continue
+                if directive == "else":
+                    if not conds: raise Exception("#else without #if.")
+                    if conds[-1][2]: raise Exception("#else after #else.")
+                    active = conds[-1][0] and not conds[-1][1]
+                    conds[-1][1] = conds[-1][2] = True
+                    continue
+                if directive == "endif":
+                    if not conds: raise Exception("#endif without #if.")
+                    active = conds.pop()[0]
+                    continue
+                if not active: continue
+
+                if directive is None:
+                    if text.lstrip()[0:1] == "#": raise Exception("Unknown preprocessor directive \""+text.split()[0]+"\".")
+                    for line in self.expandLine(item): yield ln, line
+                elif directive == "include":
+                    yield from self.include(text, directory, depth)
+                elif directive in ["define", "xdefine"]:
+                    parts = text.split(None, 1)
+                    if not parts or not _NAME.fullmatch(parts[0]): raise Exception("#"+directive+" expected a symbol name.")
+                    value = parts[1] if len(parts) > 1 else ""
+                    if directive == "xdefine": value = self.expand(value, frozenset(), 0)
+                    self.setDef(parts[0], ("define", value))
+                elif directive == "undef":
+                    if not _NAME.fullmatch(text): raise Exception("#undef expected a symbol name.")
+                    self.setDef(text, None)
+                elif directive == "macro":
+                    m = _NAME.match(text)
+                    if not m: raise Exception("#macro expected a macro name.")
+                    rest = text[m.end():].strip()
+                    if rest[0:1] + rest[-1:] in ["()", "[]"]: rest = rest[1:-1]
+                    params = [param.strip() for param in rest.split(",")] if rest.strip() else []
+                    for param in params:
+                        if not _NAME.fullmatch(param): raise Exception("Invalid macro argument name \""+param+"\".")
+                    if len(set(params)) != len(params): raise Exception("Macro arguments must have different names.")
+                    macro = [m.group(), params, [], ln]
+                elif directive == "endmacro":
+                    raise Exception("#endmacro without #macro.")
+                elif directive == "error":
+                    raise Exception(text or "#error")
+            except PreprocessError:
+                raise
+            except Exception as e:
+                raise PreprocessError(str(e), filename, ln) from e
+        if macro is not None: raise PreprocessError("#macro \""+macro[0]+"\" is missing its #endmacro.", filename, macro[3])
+        if conds: raise PreprocessError("#if is missing its #endif.", filename, conds[-1][3])
+
+    def defineMacro(self, name, params, body):
+        current = self.getDef(name)
+        overloads = {argc: (params, body) for argc, params, body in current[1]} if current and current[0] == "macro" else {}
+        overloads[len(params)] = (tuple(params), tuple(body))
+        self.setDef(name, ("macro", tuple((argc,) + overloads[argc] for argc in sorted(overloads))))
+
+    def condition(self, text):
+        def defined(m):
+            return "1" if self.getDef(m.group(1)) is not None else "0"
+        return evalCondition(self.expand(_DEFINED.sub(defined, text), frozenset(), 0))
+
+    def expandLine(self, item):
+        if not (self.defs or self.recorders): return [item[2]]
+        if item[3] is None: item[3] = [m.group("name") for m in _TOKEN.finditer(item[2]) if m.group("name")]
+        # Every name is looked up so that included files record all the names they use
+        if not any([self.getDef(name) is not None for name in item[3]]): return [item[2]]
+        return self.expand(item[2], frozenset(), 0).split("\n")
+
+    # Expands the symbols and macros in text. Those in active are being expanded already and are left as is.
+    def expand(self, text, active, depth):
+        if depth > MAX_DEPTH: raise Exception("Macros are nested too deeply.")
+        out = []
+        pos = i = 0
+        while True:
+            m = _TOKEN.search(text, i)
+            if m is None: break
+            i = m.end()
+            name = m.group("name")
+            if not name or name in active: continue
+            definition = self.getDef(name)
+            if definition is None: continue
+            if definition[0] == "define":
+                out.append(text[pos:m.start()])
+                out.append(self.expand(definition[1], active | {name}, depth+1))
+                pos = i
+                continue
+            raw, end = parseArgs(text, i)
+            for argc, params, body in definition[1]:
+                if argc == len(raw or []): break
+            else:
+                if raw is None: continue # Only a macro with arguments of that name
+                raise Exception("Macro \""+name+"\" does not take "+str(len(raw))+" arguments.")
+            raw = raw or []
+            args = [self.expand(arg, active, depth+1) for arg in raw]
+            start = max(pos, text.rfind("\n", 0, m.start()) + 1)
+            if text[start:m.start()].strip(): start = m.start()
+            out.append(text[pos:start]) # The body keeps its own indentation when the macro starts the line
+            out.append(self.expand(instantiate(params, body, raw, args), active | {name}, depth+1))
+            pos = i = end
+        out.append(text[pos:])
+        return "".join(out)
+
+    def findInclude(self, path, directory):
+        for base in [directory] + self.includedirs:
+            candidate = os.path.join(base, path)
+            if os.path.isfile(candidate): return os.path.abspath(candidate)
+        raise Exception("Couldn't find included file \""+path+"\".")
+
+    def include(self, text, directory, depth):
+        if depth >= MAX_DEPTH: raise Exception("#include is nested too deeply.")
+        path = text[1:-1] if len(text) >= 2 and text[0] + text[-1] in ["\"\"", "''", "<>"] else text
+        if not path: raise Exception("#include expected a file path.")
+        path = self.findInclude(path, directory)
+        for header in self.headers.get(path) if self.headers is not None else []:
+            if not all(self.getDef(name) == definition for name, definition in header.uses.items()): continue
+            if self.recorders:
+                for name, definition in header.effects.items(): self.setDef(name, definition)
+            else:
+                for name, definition in header.effects.items():
+                    if definition is None: self.defs.pop(name, None)
+                    else: self.defs[name] = definition
+            for outer, _ in self.recorders: outer.files.update(header.files)
+            yield from header.lines
+            return
+
+        header = Header()
+        self.recorders.append((header, set()))
+        try:
+            stamp, items = parseFile(path)
+            header.files[path] = stamp
+            for ln, line in self.process(items, path, os.path.dirname(path), depth+1):
+                origin = ln if isinstance(ln, tuple) else (path, ln)
+                header.lines.append((origin, line))
+                yield origin, line
+        finally:
+            self.recorders.pop()
+        for outer, _ in self.recorders: outer.files.update(header.files)
+        if self.headers is not None: self.headers.put(path, header)
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "o:hI:D:", ["help", "pch="])
+    outfile = None
+    includedirs, defines, headers = [], {}, None
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Runs the preprocessor over a Mercury Assembly file.")
+            print("Usage: py preprocessor.py [options] file")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-I DIR: Search DIR for #include files after the directory of the including file.")
+            print("\t-D NAME[=VALUE]: Define the preprocessor symbol NAME as VALUE (Default 1).")
+            print("\t--pch=FILE: Keep precompiled #include files in FILE, shared between runs.")
+            print("\t-o OUTPUT: Specify OUTPUT as the output file (Default: standard output).\n")
+            print("\tfile is the assembly file to preprocess.\n")
+            exit(0)
+        if o == "-I":
+            includedirs.append(a)
+        if o == "-D":
+            name, _, value = a.partition("=")
+            defines[name] = value if _ else "1"
+        if o == "--pch":
+            headers = HeaderCache(a)
+        if o == "-o":
+            outfile = a
+    if len(args) != 1:
+        print("[FATAL] Expected exactly one file to preprocess.")
+        exit(-1)
+
+    try:
+        lines = [line for _, line in Preprocessor(includedirs, defines, headers).iterfile(args[0])]
+    except (PreprocessError, OSError) as e:
+        print("[FATAL] Couldn't preprocess due to the following exception:")
+        print(e)
+        exit(-1)
+    if headers and headers.added: headers.save()
+    if outfile is None:
+        for line in lines: print(line)
+        return
+    with open(outfile, "w") as f:
+        for line in lines: f.write(line + "\n")
+    print("$ - (SUCCESS) Preprocessed to "+outfile)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
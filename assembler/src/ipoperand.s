@@ -0,0 +1,11 @@
+    .text
+    ; @ip and @sp are not constants: every operand below keeps its 32-bit form
+    ; and gets the address of its own instruction.
+        .dec 1, 2, 3
+        JMP  @ip
+        JMP  @ip
+        MOVL %AB, @ip
+        MVI  %ML, @sp
+    ; .set symbols are constants, so this offset is shrunk to 16 bits.
+        .set THERE, 3
+        JMP  THERE
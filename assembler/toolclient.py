@@ -0,0 +1,294 @@
+import os, sys, json, socket, struct, getopt, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from objcache import ObjectCache
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "mercury-toolchain-"+str(os.getuid())+".sock")
+
+# Messages are a little-endian u32 length, a JSON header of that length and then the
+# blobs (sources, objects or images) whose sizes are listed in the header.
+def sendMessage(sock, header, blobs=()):
+    data = json.dumps(dict(header, sizes=[len(blob) for blob in blobs])).encode()
+    sock.sendall(struct.pack("<I", len(data)) + data)
+    for blob in blobs: sock.sendall(blob)
+
+def recvExactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(min(n - len(data), 1 << 20))
+        if not chunk: raise ConnectionError("Connection closed in the middle of a message.")
+        data.extend(chunk)
+    return bytes(data)
+
+# Returns (header, blobs), or None if the connection was closed between messages
+def recvMessage(sock):
+    size = sock.recv(4, socket.MSG_WAITALL)
+    if not size: return None
+    if len(size) < 4: size += recvExactly(sock, 4 - len(size))
+    header = json.loads(recvExactly(sock, struct.unpack("<I", size)[0]))
+    return header, [recvExactly(sock, n) for n in header.pop("sizes")]
+
+# Sends one request to the server over a new connection and returns its reply
+def request(path, header, blobs=()):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sendMessage(sock, header, blobs)
+        reply = recvMessage(sock)
+    if reply is None: raise ConnectionError("The server closed the connection without replying.")
+    return reply
+
+# Includes are read by the server, so every path it is sent is absolute. The object cache
+# is looked up by the server too, as objects are keyed by the preprocessed source.
+def assembleRemote(path, in_filepath, out_dirpath, options):
+    verbose, lexengine, cache, includedirs, defines, pchpath = options
+    output = "[FILE] "+in_filepath+"\n" if verbose else ""
+    out_filepath = os.path.splitext(os.path.basename(in_filepath))[0] + ".o"
+    out_filepath = os.path.join(out_dirpath, out_filepath)
+    with open(in_filepath, "rb") as f:
+        source = f.read()
+
+    reply, blobs = request(path, {"cmd": "assemble", "name": in_filepath, "verbose": verbose, "lexer": lexengine,
+                                  "dir": os.path.dirname(os.path.abspath(in_filepath)), "includedirs": includedirs,
+                                  "defines": defines, "pch": pchpath, "cache": os.path.abspath(cache.directory) if cache else None}, [source])
+    output += reply["output"]
+    if not reply["ok"]: return False, output + "$ - (ERROR) "+reply["error"].split("\n")[0]+"\n"
+    with open(out_filepath, "wb") as f:
+        f.write(blobs[0])
+    if cache:
+        if reply["cached"]: cache.hits += 1
+        else: cache.misses += 1
+    return True, output + "$ - (SUCCESS) "+in_filepath+" -> "+out_filepath+(" (cached)" if cache and reply["cached"] else "")+"\n"
+
+def asmMain(path, argv):
+    opts, args = getopt.getopt(argv, "d:hj:vI:D:", ["help", "verbose", "lexer=", "cache=", "cache-size=", "cache-stats", "pch="])
+    files = []
+    verbose, outdir, lexengine, jobs = False, "", "fast", 1
+    cachedir, cachesize, cachestats = None, 512, False
+    includedirs, defines, pchpath = [], {}, None
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Assembles Mercury Assembly files into SLBF object files on the toolchain server.")
+            print("Usage: py toolclient.py [-s SOCKET] asm [options] files...")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-v | --verbose: Display extra information on the assembling process.")
+            print("\t--lexer=ENGINE: Use the \"fast\" single-pass tokenizer (Default) or the \"legacy\" one.")
+            print("\t-j N: Send up to N files to the server at once.")
+            print("\t--cache=DIR: Copy the objects of files assembled before from the cache in DIR instead of assembling them.")
+            print("\t--cache-size=MIB: Evict least recently used objects until the cache fits in MIB MiB (Default 512).")
+            print("\t--cache-stats: Display the cache statistics after assembling.")
+            print("\t-I DIR: Search DIR for #include files after the directory of the including file.")
+            print("\t-D NAME[=VALUE]: Define the preprocessor symbol NAME as VALUE (Default 1).")
+            print("\t--pch=FILE: Keep precompiled #include files in FILE, shared between runs and workers.")
+            print("\t-d OUTPUT: Specify OUTPUT as the output directory. Creates OUTPUT if it does not exist. Must not be a file.\n")
+            print("\tfile... is a list of assembly files to compile.\n")
+            exit(0)
+        if o in ["-v", "--verbose"]:
+            verbose = True
+        if o == "--lexer":
+            if a not in ["fast", "legacy"]:
+                print("[FATAL] Unknown lexer \""+a+"\". Expected \"fast\" or \"legacy\".")
+                exit(-1)
+            lexengine = a
+        if o == "-j":
+            if not a.isdigit() or int(a) < 1:
+                print("[FATAL] Invalid job count \""+a+"\". Expected a positive integer.")
+                exit(-1)
+            jobs = int(a)
+        if o == "-d":
+            if os.path.isfile(a):
+                print("[WARNING] Specified output directory \""+a+"\" is already an existing file.")
+                continue
+            outdir = a
+        if o == "--cache":
+            cachedir = a
+        if o == "--cache-size":
+            if not a.isdigit():
+                print("[FATAL] Invalid cache size \""+a+"\". Expected a number of MiB.")
+                exit(-1)
+            cachesize = int(a)
+        if o == "--cache-stats":
+            cachestats = True
+        if o == "-I":
+            includedirs.append(os.path.abspath(a))
+        if o == "-D":
+            name, _, value = a.partition("=")
+            defines[name] = value if _ else "1"
+        if o == "--pch":
+            pchpath = os.path.abspath(a)
+    cache = None
+    if cachedir:
+        if os.path.isfile(cachedir):
+            print("[FATAL] Specified cache directory \""+cachedir+"\" is an existing file.")
+            exit(-1)
+        cache = ObjectCache(cachedir, cachesize << 20)
+    if not outdir:
+        print("[WARNING] Valid output directory was not specified. Defaulting to current directory")
+        outdir = "."
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    for arg in args:
+        if not os.path.isfile(arg):
+            print("[WARNING] \""+arg+"\" is not a file or does not exist.")
+            continue
+        files.append(arg)
+    if len(files) == 0:
+        print("[FATAL] No files to assemble.")
+        exit(-1)
+
+    failed = 0
+    with ThreadPoolExecutor(min(jobs, len(files))) as pool:
+        results = pool.map(lambda in_filepath: assembleRemote(path, in_filepath, outdir, (verbose, lexengine, cache, includedirs, defines, pchpath)), files)
+        for ok, output in results:
+            print(output, end="")
+            if not ok: failed += 1
+    if cache:
+        cache.saveStats()
+        cache.evict()
+        if cachestats: print(cache.reprStats())
+    if failed:
+        print("[FATAL] "+str(failed)+" of "+str(len(files))+" files failed to assemble.")
+        exit(-1)
+
+def linkMain(path, argv):
+    opts, args = getopt.getopt(argv, "o:hv", ["help", "lib", "verbose", "entry=", "compact-strings", "presize-hash"])
+    files = []
+    islib, verbose, entrysymbol, compact, presize = False, False, "main", False, False
+    outfile = "a.mx"
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Links Mercury SLBF Object files into executable files on the toolchain server.")
+            print("Usage: py toolclient.py [-s SOCKET] link [options] files...")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-v | --verbose: Display extra information on the linking process.")
+            print("\t--lib: Builds a library out of the specified files instead of an executable.")
+            print("\t--entry: Specifies an entry symbol for executables (Default: main)")
+            print("\t--compact-strings: Store each name once and share the tails of names in the output string tables.")
+            print("\t--presize-hash: Size the symbol hash table for every input symbol up front instead of growing it while linking.")
+            print("\t-o OUTPUT: Specify OUTPUT as the output file.\n")
+            print("\tfile... is a list of object files to link.\n")
+            exit(0)
+        if o in ["-v", "--verbose"]:
+            verbose = True
+        if o == "--lib":
+            if outfile == "a.mx": outfile = "a.mlib"
+            islib = True
+        if o == "--entry":
+            entrysymbol = a
+        if o == "--compact-strings":
+            compact = True
+        if o == "--presize-hash":
+            presize = True
+        if o == "-o":
+            if os.path.isfile(a):
+                print("[WARNING] Output file already exists and will be overwritten.")
+                if input("Continue linking? (Y/N)").lower() != "y": exit(0)
+            outfile = a
+    for arg in args:
+        if not os.path.isfile(arg):
+            print("[WARNING] \""+arg+"\" is not a file or does not exist.")
+            continue
+        files.append(arg)
+    if len(files) == 0:
+        print("[FATAL] No files to link.")
+        exit(-1)
+
+    objects = []
+    for in_filepath in files:
+        with open(in_filepath, "rb") as f:
+            objects.append(f.read())
+    reply, blobs = request(path, {"cmd": "link", "names": files, "verbose": verbose, "lib": islib, "entry": entrysymbol, "compact": compact, "presize": presize}, objects)
+    print(reply["output"], end="")
+    if not reply["ok"]:
+        print("[FATAL] Couldn't link due to the following exception:")
+        print(reply["error"])
+        exit(-1)
+
+    with open(outfile, "wb") as f:
+        f.write(blobs[0])
+    print("$ - (SUCCESS) Linked to "+outfile)
+
+def loadMain(path, argv):
+    opts, args = getopt.getopt(argv, "o:hv", ["help", "verbose"])
+    outfile = "a.lsi"
+    verbose = False
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Creates a logisim memory image from a Mercury SLBF executable with no section relocation on the toolchain server.")
+            print("Usage: py toolclient.py [-s SOCKET] load [options] file")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-v | --verbose: Display extra information on the loading process.")
+            print("\t-o OUTPUT: Specify OUTPUT as the output file.\n")
+            print("\tfile is the executable file to load.\n")
+            exit(0)
+        if o in ["-v", "--verbose"]:
+            verbose = True
+        if o == "-o":
+            if os.path.isfile(a):
+                print("[WARNING] Output file already exists and will be overwritten.")
+                if input("Continue linking? (Y/N)").lower() != "y": exit(0)
+            outfile = a
+
+    if len(args) == 0:
+        print("[FATAL] No executable file was specified.")
+        exit(-1)
+
+    if len(args) > 1:
+        print("[WARNING] There is more than one input file specified.\nOnly the first one will be used.")
+
+    if not os.path.isfile(args[0]):
+        print("[FATAL] \""+args[0]+"\" is not a file or does not exist.")
+        exit(-2)
+
+    with open(args[0], "rb") as f:
+        reply, blobs = request(path, {"cmd": "load", "name": args[0], "verbose": verbose}, [f.read()])
+    print(reply["output"], end="")
+    if not reply["ok"]:
+        print("[FATAL] Couldn't flat load due to the following exception:")
+        print(reply["error"])
+        exit(-3)
+
+    with open(outfile, "wb") as f:
+        f.write(blobs[0])
+    print("$ - (SUCCESS) Loaded flat to "+outfile)
+
+TOOLS = {"asm": asmMain, "link": linkMain, "load": loadMain}
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "hs:", ["help", "socket=", "stop"])
+    path = DEFAULT_SOCKET
+    stop = False
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Runs asm.py, linker.py or flatloader.py on a toolchain server started with toolserver.py.")
+            print("Usage: py toolclient.py [options] asm|link|load [tool options] files...")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-s SOCKET | --socket=SOCKET: Connect to the server listening on SOCKET (Default "+DEFAULT_SOCKET+").")
+            print("\t--stop: Stop the server once it has answered the requests it is working on.\n")
+            print("\tThe tool options are the ones of asm.py, linker.py and flatloader.py. Use \"asm -h\" and so on to list them.\n")
+            exit(0)
+        if o in ["-s", "--socket"]:
+            path = a
+        if o == "--stop":
+            stop = True
+    if not stop and (len(args) == 0 or args[0] not in TOOLS):
+        print("[FATAL] Expected a tool to run: asm, link or load.")
+        exit(-1)
+
+    try:
+        if stop: request(path, {"cmd": "stop"})
+        else: TOOLS[args[0]](path, args[1:])
+    except OSError as e:
+        print("[FATAL] Couldn't reach the toolchain server at \""+path+"\":")
+        print(e)
+        exit(-1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,190 @@
+import os, sys, io, pickle, getopt, hashlib, threading, contextlib, socketserver
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import asm, linker, flatloader
+from SLBFManager import *
+from objcache import ObjectCache
+from preprocessor import HeaderCache
+from toolclient import DEFAULT_SOCKET, sendMessage, recvMessage, request
+
+# Least recently used store of bytes, bounded by their total size
+class WarmCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None: self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if key in self.entries: return
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.maxsize:
+            _, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+def digest(*parts):
+    h = hashlib.sha256()
+    for part in parts: h.update(part)
+    return h.digest()
+
+# Each worker process keeps the objects it assembled, by preprocessed source, and the
+# objects it parsed, by contents. Linking modifies its input objects, so parsed objects
+# are kept pickled: unpickling a copy is several times faster than deserializing SLBF
+# again. Precompiled headers and object cache directories are kept open by path.
+assembled = None
+parsed = None
+headers = {}
+caches = {}
+
+def _initworker(cachesize):
+    global assembled, parsed
+    assembled, parsed = WarmCache(cachesize), WarmCache(cachesize)
+
+def _warm(n):
+    return n
+
+def parseObject(data):
+    key = digest(data)
+    pickled = parsed.get(key)
+    if pickled is not None: return pickle.loads(pickled)
+    file = SLBFManager.deserializeBytes(data)
+    parsed.put(key, pickle.dumps(file))
+    return file
+
+def serveAssemble(header, blobs):
+    asm.verbose, asm.lexengine = header["verbose"], header["lexer"]
+    asm.includedirs, asm.defines = header["includedirs"], header["defines"]
+    if header["pch"] not in headers: headers[header["pch"]] = HeaderCache(header["pch"])
+    asm.headers = headers[header["pch"]]
+    lines = asm.preprocess_text(blobs[0].decode(), header["name"], header["dir"])
+    source = asm.preprocessedSource(lines, header["dir"])
+    key = digest(asm.lexengine.encode(), source)
+    data = None if header["verbose"] else assembled.get(key) # -v prints the listing of assembling it
+    if data is not None: return {"ok": True, "cached": True}, [data]
+    cache = None
+    if header["cache"]:
+        if header["cache"] not in caches: caches[header["cache"]] = ObjectCache(header["cache"])
+        cache = caches[header["cache"]]
+        diskkey = cache.key(source, (asm.lexengine,))
+        data = cache.read(diskkey)
+        if data is not None:
+            assembled.put(key, data)
+            return {"ok": True, "cached": True}, [data]
+    data = SLBFManager.serializeBytes(asm.assemble_preprocessed(lines, header["name"], False, header["dir"]))
+    assembled.put(key, data)
+    if cache: cache.write(diskkey, data)
+    return {"ok": True, "cached": False}, [data]
+
+def serveLink(header, blobs):
+    linker.verbose = header["verbose"]
+    objects = []
+    for name, data in zip(header["names"], blobs):
+        try:
+            objects.append(parseObject(data))
+        except Exception as e:
+            raise linker.LinkError(str(e), name) from e
+    file = linker.link_objects(objects, header["lib"], header["names"], header["entry"], header["presize"])
+    return {"ok": True}, [SLBFManager.serializeBytes(file, header["compact"])]
+
+def serveLoad(header, blobs):
+    flatloader.verbose = header["verbose"]
+    lines = flatloader.load_file(parseObject(blobs[0]))
+    return {"ok": True}, ["".join(line + "\n" for line in ["v3.0 hex words addressed"] + lines).encode()]
+
+COMMANDS = {"assemble": serveAssemble, "link": serveLink, "load": serveLoad}
+
+# Runs in a worker process. Whatever the tools print is returned for the client to print.
+def serve(header, blobs):
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            reply, results = COMMANDS[header["cmd"]](header, blobs)
+        except Exception as e:
+            reply, results = {"ok": False, "error": str(e)}, []
+    reply["output"] = out.getvalue()
+    return reply, results
+
+class ToolServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            message = recvMessage(self.request)
+            if message is None: return
+            header, blobs = message
+            if header["cmd"] == "stop":
+                sendMessage(self.request, {"ok": True, "output": ""})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            if header["cmd"] not in COMMANDS:
+                sendMessage(self.request, {"ok": False, "output": "", "error": "Unknown command \""+str(header["cmd"])+"\"."})
+                continue
+            try:
+                reply, results = self.server.pool.submit(serve, header, blobs).result()
+            except Exception as e:
+                reply, results = {"ok": False, "output": "", "error": str(e)}, []
+            sendMessage(self.request, reply, results)
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "hj:s:", ["help", "socket=", "cache-size="])
+    path = DEFAULT_SOCKET
+    jobs = os.cpu_count() or 1
+    cachesize = 64
+
+    for o, a in opts:
+        if o in ["-h", "--help"]:
+            print("Serves asm.py, linker.py and flatloader.py requests from toolclient.py over a Unix domain socket.")
+            print("Usage: py toolserver.py [options]")
+            print("Options:")
+            print("\t-h | --help: Display this message.")
+            print("\t-s SOCKET | --socket=SOCKET: Listen on SOCKET (Default "+DEFAULT_SOCKET+").")
+            print("\t-j N: Serve up to N requests at once in worker processes (Default "+str(jobs)+").")
+            print("\t--cache-size=MIB: Keep up to MIB MiB of assembled and of parsed objects in each worker (Default 64).\n")
+            exit(0)
+        if o in ["-s", "--socket"]:
+            path = a
+        if o == "-j":
+            if not a.isdigit() or int(a) < 1:
+                print("[FATAL] Invalid job count \""+a+"\". Expected a positive integer.")
+                exit(-1)
+            jobs = int(a)
+        if o == "--cache-size":
+            if not a.isdigit():
+                print("[FATAL] Invalid cache size \""+a+"\". Expected a number of MiB.")
+                exit(-1)
+            cachesize = int(a)
+    if os.path.exists(path):
+        try: # A server still running answers, a socket left over by one that crashed does not
+            request(path, {"cmd": "ping"})
+            print("[FATAL] A server is already listening on \""+path+"\".")
+            exit(-1)
+        except ConnectionRefusedError:
+            os.remove(path)
+
+    with ProcessPoolExecutor(jobs, initializer=_initworker, initargs=(cachesize << 20,)) as pool:
+        for _ in pool.map(_warm, range(jobs)): pass # Start every worker before accepting connections
+        umask = os.umask(0o177) # Only the owner may connect
+        try:
+            server = ToolServer(path, RequestHandler)
+        finally:
+            os.umask(umask)
+        server.pool = pool
+        print("$ - Listening on "+path+" with "+str(jobs)+" workers")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(path)
+    print("$ - Stopped")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])